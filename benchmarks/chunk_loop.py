@@ -0,0 +1,76 @@
+"""Allocation churn and time of the chunk loop with and without scratch reuse.
+
+Converts random audio with a randomly initialized v2 40k synthesizer and the
+HuBERT checkpoint in rvc/, once allocating fresh batch buffers for every
+chunk and once reusing them. On CUDA the number of allocations and the
+allocated bytes reported by the caching allocator are compared as well.
+
+    python benchmarks/chunk_loop.py [--seconds 300] [--device cpu] [--runs 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from rvc.infer import Config
+from rvc.lib.autotune import V2_40K_CONFIG
+from rvc.lib.infer_pack.models import SynthesizerTrnMs768NSFsid
+from rvc.lib.prepare import fold_weight_norm
+from rvc.lib.vc_infer_pipeline import VC
+
+
+def run(vc, config, net_g, audio, runs: int) -> tuple:
+    is_cuda = str(config.device).startswith("cuda")
+    sid = torch.tensor([0], device=config.device).long()
+    times = []
+    allocations = allocated_bytes = 0
+    for _ in range(runs + 1):
+        if is_cuda:
+            torch.cuda.synchronize()
+            before = torch.cuda.memory_stats(config.device)
+        t0 = time.perf_counter()
+        # rmvpe and the caches are left out, only the chunk loop is measured
+        vc.convert_span(config.hubert_model, net_g, sid, audio, "", [0, 0, 0], 0, "pm", None, None, 0, 1, 3, "v2", 0.33)
+        times.append(time.perf_counter() - t0)
+        if is_cuda:
+            after = torch.cuda.memory_stats(config.device)
+            allocations = after["allocation.all.allocated"] - before["allocation.all.allocated"]
+            allocated_bytes = after["allocated_bytes.all.allocated"] - before["allocated_bytes.all.allocated"]
+        vc.release_scratch()
+    # the first run only warms up
+    return sorted(times[1:])[len(times[1:]) // 2], allocations, allocated_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=300)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    config = Config(args.device)
+    config.feature_cache = None
+    config.load_hubert(12)
+    net_g = SynthesizerTrnMs768NSFsid(*V2_40K_CONFIG, is_half=config.is_half)
+    del net_g.enc_q
+    fold_weight_norm(net_g)
+    net_g = net_g.eval().to(config.device)
+    net_g = net_g.half() if config.is_half else net_g.float()
+    vc = VC(40000, config)
+    audio = np.random.default_rng(0).standard_normal(int(args.seconds * 16000)) * 0.1
+
+    for reuse in [False, True]:
+        vc.reuse_scratch = reuse
+        elapsed, allocations, allocated_bytes = run(vc, config, net_g, audio, args.runs)
+        print(f"{'reused' if reuse else 'fresh '} buffers: {elapsed:8.2f} s", end="")
+        if str(config.device).startswith("cuda"):
+            print(f", {allocations} allocations, {allocated_bytes / 2**20:.0f} MB allocated", end="")
+        print()
+
+
+if __name__ == "__main__":
+    main()
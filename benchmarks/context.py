@@ -0,0 +1,111 @@
+"""Quality and throughput of the chunk context lengths.
+
+Converts one input with padded chunks (`x_pad` seconds of context, the
+default) and with overlapping, cross-faded chunks for each `--contexts`
+length (`Config.x_context`). Each output is compared to a conversion of
+the whole input in one chunk by the mean log spectral distance, over the
+whole output and within a quarter second of the seams. Two whole-input
+conversions with different seeds give the noise floor, since the
+synthesizer samples noise.
+
+Without `--model` a randomly initialized v2 40k synthesizer is used, which
+is enough to compare speed and seams but not to judge the voice.
+
+    python benchmarks/context.py --input in/song.wav [--model models/voice.pth] [--contexts 0.5 0.25 0.1] [--device cpu]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from rvc.infer import Config, VoiceModel
+from rvc.lib.audio import load_audio
+from rvc.lib.autotune import V2_40K_CONFIG
+from rvc.lib.infer_pack.models import SynthesizerTrnMs768NSFsid
+from rvc.lib.prepare import fold_weight_norm
+from rvc.lib.vc_infer_pipeline import VC, bh, ah
+from scipy import signal
+
+SEAM_SECONDS = 0.25
+
+
+def build_model(config, model_path: str):
+    if model_path is not None:
+        voice_model = VoiceModel(model_path, config)
+        return voice_model.net_g, voice_model.tgt_sr, voice_model.version, voice_model.if_f0
+    net_g = SynthesizerTrnMs768NSFsid(*V2_40K_CONFIG, is_half=config.is_half)
+    del net_g.enc_q
+    fold_weight_norm(net_g)
+    net_g = net_g.eval().to(config.device)
+    return (net_g.half() if config.is_half else net_g.float()), 40000, "v2", 1
+
+
+def convert(config, net_g, tgt_sr, version, if_f0, audio, whole=False, seed=0) -> tuple:
+    vc = VC(tgt_sr, config)
+    if whole:
+        vc.set_geometry(vc.x_pad, vc.x_query, 10**6, 10**6)
+    sid = torch.tensor([0], device=config.device).long()
+    torch.manual_seed(seed)
+    t0 = time.perf_counter()
+    output = vc.convert_span(config.hubert_model, net_g, sid, audio, "", [0, 0, 0], 0, "rmvpe", None, None, 0, if_f0, 3, version, 0.33)
+    elapsed = time.perf_counter() - t0
+    seams = [t // vc.window * vc.window for t in vc.split_points(audio)]
+    if not vc.overlap and seams:
+        # padded chunks repeat the frame at each seam, drop the repeats to line up
+        upp = tgt_sr // 100
+        starts = [(t // vc.window + j + 1) * upp for j, t in enumerate(seams)]
+        output = np.delete(output, np.concatenate([np.arange(start, start + upp) for start in starts]))
+    return output, elapsed, seams
+
+
+def log_spectrum(audio, n_fft=2048, hop=512):
+    spectrum = torch.stft(torch.from_numpy(audio).float(), n_fft, hop, window=torch.hann_window(n_fft), return_complex=True)
+    return torch.log(spectrum.abs() + 1e-5).numpy()
+
+
+def distances(output, reference, seams, tgt_sr, hop=512) -> tuple:
+    n = min(output.shape[0], reference.shape[0])
+    difference = np.abs(log_spectrum(output[:n]) - log_spectrum(reference[:n])).mean(axis=0)
+    near = np.zeros(difference.shape[0], dtype=bool)
+    for t in seams:
+        center = t / 16000 * tgt_sr / hop
+        radius = SEAM_SECONDS * tgt_sr / hop
+        near[max(0, int(center - radius)) : int(center + radius) + 1] = True
+    return difference.mean(), difference[near].mean() if near.any() else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--contexts", type=float, nargs="+", default=[0.5, 0.25, 0.1])
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    config = Config(args.device)
+    config.feature_cache = None
+    config.load_hubert(12)
+    net_g, tgt_sr, version, if_f0 = build_model(config, args.model)
+    audio = signal.filtfilt(bh, ah, load_audio(args.input, 16000))
+    seconds = audio.shape[0] / 16000
+
+    reference, _, _ = convert(config, net_g, tgt_sr, version, if_f0, audio, whole=True, seed=0)
+    floor, _, _ = convert(config, net_g, tgt_sr, version, if_f0, audio, whole=True, seed=1)
+    print(f"{'mode':<24}{'realtime':>10}{'distance':>10}{'at seams':>10}")
+    overall, _ = distances(floor, reference, [], tgt_sr)
+    print(f"{'noise floor':<24}{'':>10}{overall:10.3f}{'':>10}")
+
+    settings = [("padded, x_pad " + str(config.x_pad), None)] + [(f"overlap, context {c}", c) for c in args.contexts]
+    for name, context in settings:
+        config.x_context = context
+        output, elapsed, seams = convert(config, net_g, tgt_sr, version, if_f0, audio)
+        overall, at_seams = distances(output, reference, seams, tgt_sr)
+        print(f"{name:<24}{seconds / elapsed:9.1f}x{overall:10.3f}{at_seams:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
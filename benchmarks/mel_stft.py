@@ -0,0 +1,65 @@
+"""RMVPE mel front-end time with the torch.stft and conv1d STFT backends.
+
+Runs `MelSpectrogram` with the RMVPE settings over random audio and reports
+the median time of both backends and the largest difference between their
+log mel outputs, for each key shift, with and without centered frames. The
+run fails if the outputs differ by more than `MAX_DIFFERENCE`.
+
+    python benchmarks/mel_stft.py [--seconds 300] [--runs 5] [--device cpu] [--keyshift 0 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from rvc.lib.rmvpe import MelSpectrogram
+
+# float32 rounding of the two transforms, on log mel values
+MAX_DIFFERENCE = 1e-2
+
+
+def time_mel(mel_extractor, audio, keyshift: int, center: bool, runs: int, device: str) -> tuple:
+    times = []
+    with torch.no_grad():
+        for _ in range(runs + 1):
+            t0 = time.perf_counter()
+            output = mel_extractor(audio, keyshift=keyshift, center=center)
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - t0)
+    # the first run only warms up
+    return sorted(times[1:])[len(times[1:]) // 2], output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=300)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--keyshift", type=int, nargs="+", default=[0, 3])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    audio = torch.randn(1, int(args.seconds * 16000), device=args.device) * 0.1
+    extractors = {
+        backend: MelSpectrogram(False, 128, 16000, 1024, 160, None, 30, 8000, stft_backend=backend).to(args.device)
+        for backend in ["conv", "fft"]
+    }
+    for keyshift in args.keyshift:
+        for center in [True, False]:
+            conv_time, expected = time_mel(extractors["conv"], audio, keyshift, center, args.runs, args.device)
+            fft_time, actual = time_mel(extractors["fft"], audio, keyshift, center, args.runs, args.device)
+            difference = (expected - actual).abs().max().item()
+            print(f"keyshift {keyshift}, center {center}:")
+            print(f"  conv1d STFT:        {conv_time * 1000:8.1f} ms")
+            print(f"  torch.stft:         {fft_time * 1000:8.1f} ms")
+            print(f"  speedup:            {conv_time / fft_time:8.2f}x")
+            print(f"  max abs difference: {difference:.2e}")
+            assert expected.shape == actual.shape, (expected.shape, actual.shape)
+            assert difference <= MAX_DIFFERENCE, f"the backends differ by {difference:.2e}"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Conversion time with the index search pipelined against the synthesis.
+
+Converts one input with `Config.pipeline_retrieval` off, where every batch
+of chunks is searched and then synthesized, and on, where the search of the
+next batch runs on a worker thread during the synthesis. On cpu
+`--retrieval-threads` cores are left to faiss and the rest to torch. The
+input has to be long enough for several chunks.
+
+Without `--model` a randomly initialized v2 40k synthesizer is used and
+without `--index` a flat index over `--index-size` random vectors, which is
+enough to compare the speed but not to judge the voice.
+
+    python benchmarks/retrieval.py --input in/song.wav [--model models/voice.pth --index models/index/voice.index] [--device cpu] [--retrieval-threads 0]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from rvc.infer import Config
+from rvc.lib.audio import load_audio
+from rvc.lib.index_cache import load_index
+from rvc.lib.vc_infer_pipeline import VC, bh, ah
+from scipy import signal
+from context import build_model
+
+
+def random_index(size: int, n_channels: int):
+    import faiss
+
+    big_npy = np.random.default_rng(0).standard_normal((size, n_channels)).astype(np.float32)
+    index = faiss.IndexFlatL2(n_channels)
+    index.add(big_npy)
+    return index, big_npy
+
+
+def time_conversion(config, net_g, tgt_sr, version, if_f0, audio, index, big_npy, runs: int) -> float:
+    vc = VC(tgt_sr, config)
+    sid = torch.tensor([0], device=config.device).long()
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        vc.convert_span(config.hubert_model, net_g, sid, audio, "", [0, 0, 0], 0, "rmvpe", index, big_npy, 0.75, if_f0, 3, version, 0.33)
+        times.append(time.perf_counter() - t0)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--index", default=None)
+    parser.add_argument("--index-size", type=int, default=100000)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--retrieval-threads", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    config = Config(args.device)
+    config.feature_cache = None
+    config.retrieval_threads = args.retrieval_threads
+    net_g, tgt_sr, version, if_f0 = build_model(config, args.model)
+    config.load_hubert(9 if version == "v1" else 12)
+    if args.index is not None:
+        index, big_npy = load_index(args.index, config.is_half)
+    else:
+        index, big_npy = random_index(args.index_size, 256 if version == "v1" else 768)
+    audio = signal.filtfilt(bh, ah, load_audio(args.input, 16000))
+    seconds = audio.shape[0] / 16000
+
+    # the first conversion fills the f0 cache and warms up the models
+    time_conversion(config, net_g, tgt_sr, version, if_f0, audio, index, big_npy, 1)
+    print(f"{'retrieval':<12}{'seconds':>10}{'realtime':>10}")
+    for pipelined in [False, True]:
+        config.pipeline_retrieval = pipelined
+        elapsed = time_conversion(config, net_g, tgt_sr, version, if_f0, audio, index, big_npy, args.runs)
+        print(f"{'pipelined' if pipelined else 'serial':<12}{elapsed:10.2f}{seconds / elapsed:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
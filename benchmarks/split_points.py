@@ -0,0 +1,75 @@
+"""Chunk boundary search of the pipeline, vectorized against the former loop.
+
+Builds random speech-like audio with pauses and compares the boundaries
+and the run time of `VC.split_points` with the former per-sample loop for
+the cpu settings (x_query 6, x_center 38) of `Config`. The run fails if
+any boundary differs.
+
+    python benchmarks/split_points.py [--minutes 60] [--seed 0]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from rvc.lib.vc_infer_pipeline import VC
+
+
+class BenchmarkConfig:
+    x_pad, x_query, x_center, x_max = 1, 6, 38, 41
+    x_context = None
+    is_half = False
+    device = "cpu"
+
+
+def loop_split_points(vc, audio):
+    audio_pad = np.pad(audio, (vc.window // 2, vc.window // 2), mode="reflect")
+    opt_ts = []
+    if audio_pad.shape[0] > vc.t_max:
+        audio_sum = np.zeros_like(audio)
+        for i in range(vc.window):
+            audio_sum += audio_pad[i : i - vc.window]
+        for t in range(vc.t_center, audio.shape[0], vc.t_center):
+            opt_ts.append(
+                t
+                - vc.t_query
+                + np.where(
+                    np.abs(audio_sum[t - vc.t_query : t + vc.t_query])
+                    == np.abs(audio_sum[t - vc.t_query : t + vc.t_query]).min()
+                )[0][0]
+            )
+    return opt_ts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n = int(args.minutes * 60 * 16000)
+    audio = rng.standard_normal(n) * 0.1
+    # pauses of up to two seconds, some digitally silent
+    for start in rng.integers(0, n, size=max(1, n // 16000 // 10)):
+        length = int(rng.integers(1600, 32000))
+        audio[start : start + length] *= 0 if rng.random() < 0.5 else 1e-3
+
+    vc = VC(40000, BenchmarkConfig())
+    t0 = time.perf_counter()
+    expected = [int(t) for t in loop_split_points(vc, audio)]
+    t1 = time.perf_counter()
+    actual = vc.split_points(audio)
+    t2 = time.perf_counter()
+    print(f"loop:       {t1 - t0:8.3f} s")
+    print(f"vectorized: {t2 - t1:8.3f} s")
+    print(f"boundaries: {len(actual)}, identical: {expected == actual}")
+    moved = [(a, b) for a, b in zip(expected, actual) if a != b]
+    assert expected == actual, f"moved boundaries (loop, vectorized): {moved[:10]}"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Startup time benchmark for main.py.
+
+Measures how long a fresh interpreter needs to import main.py and validate a
+settings file, and checks that none of the heavy inference dependencies are
+imported on the way. Exits with a non-zero status when the median time
+exceeds the limit or a heavy module shows up, so it can guard against
+regressions.
+
+    python benchmarks/startup.py [--runs 5] [--limit 0.5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ["torch", "fairseq", "faiss", "librosa", "parselmouth", "pyworld", "torchcrepe"]
+
+SETTINGS = {
+    "pitch_adjustment": 0,
+    "pitch_extraction_method": "rmvpe",
+    "device": "cpu",
+}
+
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+interface = main.CLI_Interface()
+interface.load_settings()
+t2 = time.perf_counter()
+print(json.dumps({
+    "import": t1 - t0,
+    "settings": t2 - t1,
+    "heavy": [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def run_probe(repo_root: str) -> dict:
+    with tempfile.TemporaryDirectory() as cwd:
+        with open(os.path.join(cwd, "settings.json"), "w") as file:
+            json.dump(SETTINGS, file)
+        env = dict(os.environ, PYTHONPATH=repo_root)
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], cwd=cwd, env=env, capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--limit", type=float, default=0.5, help="maximum median startup time in seconds")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [run_probe(repo_root) for _ in range(args.runs)]
+    import_time = statistics.median(result["import"] for result in results)
+    settings_time = statistics.median(result["settings"] for result in results)
+    total = import_time + settings_time
+    heavy = sorted(set(name for result in results for name in result["heavy"]))
+    print(f"import main:    {import_time * 1000:8.1f} ms")
+    print(f"load settings:  {settings_time * 1000:8.1f} ms")
+    print(f"total (median): {total * 1000:8.1f} ms over {args.runs} runs")
+
+    failed = False
+    if heavy:
+        print(f"Heavy modules imported during startup: {', '.join(heavy)}")
+        failed = True
+    if total > args.limit:
+        print(f"Startup takes longer than the limit of {args.limit * 1000:.0f} ms.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
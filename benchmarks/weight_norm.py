@@ -0,0 +1,84 @@
+"""Per-chunk `net_g.infer` time with and without weight norm folding.
+
+Uses the given voice model or, without one, a randomly initialized v2 40k
+synthesizer. The same random seed is used for both passes so the outputs
+can be compared.
+
+    python benchmarks/weight_norm.py [--model models/voice.pth] [--frames 4000] [--runs 5] [--device cpu]
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from rvc.lib import model_format
+from rvc.lib.autotune import V2_40K_CONFIG
+from rvc.lib.infer_pack.models import SynthesizerTrnMs256NSFsid, SynthesizerTrnMs768NSFsid
+from rvc.lib.prepare import fold_weight_norm
+
+
+def build_model(model_path: str):
+    if model_path is None:
+        net_g = SynthesizerTrnMs768NSFsid(*V2_40K_CONFIG, is_half=False)
+        return net_g, 768
+    cpt = torch.load(model_path, map_location="cpu")
+    metadata = model_format.checkpoint_metadata(cpt)
+    if metadata["f0"] != 1:
+        raise ValueError("The benchmark needs a model with f0.")
+    if metadata["version"] == "v1":
+        net_g, dim = SynthesizerTrnMs256NSFsid(*metadata["config"], is_half=False), 256
+    else:
+        net_g, dim = SynthesizerTrnMs768NSFsid(*metadata["config"], is_half=False), 768
+    net_g.load_state_dict(cpt["weight"], strict=False)
+    return net_g, dim
+
+
+def time_infer(net_g, inputs, runs: int, device: str) -> tuple:
+    times = []
+    with torch.no_grad():
+        for _ in range(runs + 1):
+            torch.manual_seed(0)
+            t0 = time.perf_counter()
+            output = net_g.infer(*inputs)[0]
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - t0)
+    # the first run only warms up
+    return sorted(times[1:])[len(times[1:]) // 2], output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--frames", type=int, default=4000, help="frames per chunk, 100 frames are one second")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    net_g, dim = build_model(args.model)
+    del net_g.enc_q
+    net_g = net_g.eval().to(args.device)
+    folded = copy.deepcopy(net_g)
+    fold_weight_norm(folded)
+
+    phone = torch.randn(1, args.frames, dim, device=args.device)
+    lengths = torch.tensor([args.frames], device=args.device).long()
+    pitch = torch.randint(1, 255, (1, args.frames), device=args.device).long()
+    pitchf = torch.rand(1, args.frames, device=args.device) * 400 + 100
+    sid = torch.tensor([0], device=args.device).long()
+    inputs = (phone, lengths, pitch, pitchf, sid)
+
+    before, expected = time_infer(net_g, inputs, args.runs, args.device)
+    after, actual = time_infer(folded, inputs, args.runs, args.device)
+    print(f"weight norm:        {before * 1000:8.1f} ms per chunk")
+    print(f"folded weight norm: {after * 1000:8.1f} ms per chunk")
+    print(f"speedup:            {before / after:8.2f}x")
+    print(f"max abs difference: {(expected - actual).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
 import logging
 logging.basicConfig(level=logging.ERROR)
 
-from rvc.infer import infer
 import os
 import sys
 import json
-import torch
+
+
+# torch is only imported once cuda devices need to be listed so that menus and
+# settings validation come up without waiting for the heavy imports
+def cuda_devices() -> list:
+    import torch
+
+    return [torch.cuda.get_device_name(i) for i in range(torch.cuda.device_count())]
 
 
 class CLI_Interface:
@@ -16,6 +22,13 @@ class CLI_Interface:
         self.device = ""
         self.pitch_extraction_method = ""
         self.audio = []
+        self.model_cache_mb = 4096
+        self.daemon_port = 8765
+        self.feature_cache_disk = False
+        self.f0_cache_disk = True
+        self.skip_silence = False
+        self.chunk_context = None
+        self.catalog = None
         
     def load_settings(self):
         with open("settings.json", "r") as file:
@@ -28,7 +41,7 @@ class CLI_Interface:
                 print(f"Invalid pitch adjustment {settings['pitch_adjustment']} in settings.")
 
         if "pitch_extraction_method" in settings:
-            if settings["pitch_extraction_method"] in ["pm", "harvest", "crepe", "rmvpe"]:
+            if settings["pitch_extraction_method"] in ["pm", "harvest", "crepe", "crepe-tiny", "crepe-fast", "rmvpe"]:
                 self.pitch_extraction_method = settings["pitch_extraction_method"]
             else:
                 print(f"Invalid pitch extraction method {settings['pitch_extraction_method']} in settings.")
@@ -37,33 +50,16 @@ class CLI_Interface:
             models = []
             if isinstance(settings["model"], str):
                 if settings["model"] == "all":
-                    for root, _, files in os.walk("models"):
-                        for file in files:
-                            if file.endswith(".pth"):
-                                models.append(os.path.join(root, file))
-                elif ";" in settings["model"]:
+                    models = self.get_catalog().model_paths()
+                elif settings["model"] != "":
                     for value in settings["model"].split(";"):
-                        model_path = os.path.join("models", value)
-                        if os.path.isfile(model_path) and os.path.exists(model_path) and model_path.endswith(".pth"):
+                        model_path = os.path.normpath(os.path.join("models", value))
+                        if self.get_catalog().is_model(model_path):
                             models.append(model_path)
-                        elif os.path.isdir(model_path) and os.path.exists(model_path):
-                            for root, _, files in os.walk(model_path):
-                                for file in files:
-                                    if file.endswith(".pth"):
-                                        models.append(os.path.join("in", root, file))
+                        elif self.get_catalog().is_category(model_path):
+                            models.extend(self.get_catalog().model_paths(model_path))
                         else:
                             print(f"Model {settings['model']} specified in settings does not exist.")
-                elif settings["model"] != "":
-                    model_path = os.path.join("models", settings["model"])
-                    if os.path.isfile(model_path) and os.path.exists(model_path) and model_path.endswith(".pth"):
-                        models.append(model_path)
-                    elif os.path.isdir(model_path) and os.path.exists(model_path):
-                        for root, _, files in os.walk(model_path):
-                            for file in files:
-                                if file.endswith(".pth"):
-                                    models.append(os.path.join("in", root, file))
-                    else:
-                        print(f"Model {settings['model']} specified in settings does not exist.")
                 else:
                     print(f"Invalid model {settings['model']} specified in settings.")
             else:
@@ -84,10 +80,11 @@ class CLI_Interface:
                     except ValueError:
                         num = None
                     if parts[0] == "cuda" and num != None:
-                        if num < torch.cuda.device_count():
+                        device_count = len(cuda_devices())
+                        if num < device_count:
                             self.device = settings["device"]
                         else:
-                            print(f"Invalid device identifier {settings['device']} with only {torch.cuda.device_count()} devices detected.")
+                            print(f"Invalid device identifier {settings['device']} with only {device_count} devices detected.")
                     else:
                         print(f"Invalid cuda device identifier {settings['device']}.")
                 else:
@@ -95,6 +92,43 @@ class CLI_Interface:
             else:
                 print(f"Field 'device' in settings needs to be a string.")
 
+        if "model_cache_mb" in settings:
+            if isinstance(settings["model_cache_mb"], int) and settings["model_cache_mb"] > 0:
+                self.model_cache_mb = settings["model_cache_mb"]
+            else:
+                print(f"Invalid model cache size {settings['model_cache_mb']} in settings.")
+
+        if "chunk_context" in settings:
+            value = settings["chunk_context"]
+            if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+                self.chunk_context = value
+            else:
+                print(f"Invalid chunk context {value} in settings.")
+
+        if "feature_cache_disk" in settings:
+            if isinstance(settings["feature_cache_disk"], bool):
+                self.feature_cache_disk = settings["feature_cache_disk"]
+            else:
+                print(f"Field 'feature_cache_disk' in settings needs to be true or false.")
+
+        if "f0_cache_disk" in settings:
+            if isinstance(settings["f0_cache_disk"], bool):
+                self.f0_cache_disk = settings["f0_cache_disk"]
+            else:
+                print(f"Field 'f0_cache_disk' in settings needs to be true or false.")
+
+        if "skip_silence" in settings:
+            if isinstance(settings["skip_silence"], bool):
+                self.skip_silence = settings["skip_silence"]
+            else:
+                print(f"Field 'skip_silence' in settings needs to be true or false.")
+
+        if "daemon_port" in settings:
+            if isinstance(settings["daemon_port"], int) and 0 < settings["daemon_port"] < 65536:
+                self.daemon_port = settings["daemon_port"]
+            else:
+                print(f"Invalid daemon port {settings['daemon_port']} in settings.")
+
         if "audio" in settings:
             if isinstance(settings["audio"], str):
                 if settings["audio"] == "all":
@@ -130,43 +164,28 @@ class CLI_Interface:
             else:
                 print(f"Field 'audio' in settings is not a string.")
 
+    # the catalog is only built once models are needed
+    def get_catalog(self):
+        if self.catalog is None:
+            from rvc.lib.catalog import Catalog
+
+            self.catalog = Catalog("models")
+        return self.catalog
+
     def index_matching(self, model_name: str, model_path: str) -> str:
-        matching_index_files = []
-        for file in os.listdir(os.path.join("models", "index")):
-            if os.path.isfile(os.path.join("models", "index", file)):
-                if file.endswith(f"{model_name}_v1.index") or file.endswith(f"{model_name}_v2.index") or file.endswith(f"{model_name}.index"):
-                    matching_index_files.append(file)
+        matching_index_files = self.get_catalog().find_indexes(model_path)
         if len(matching_index_files) == 1:
-            return os.path.join("models", "index", matching_index_files[0])
+            return matching_index_files[0]
         elif len(matching_index_files) > 1:
-            print(f"Found multiple matching indexes {matching_index_files} for model {model_name}.")
+            print(f"Found multiple matching indexes {[os.path.basename(file) for file in matching_index_files]} for model {model_name}.")
             sys.exit(1)
         else:
-            categories = os.path.sep.join(model_path.split(os.path.sep)[1:])
-            if categories != "":
-                matching_index_files = []
-                for file in os.listdir(os.path.join("models", "index", categories)):
-                    if os.path.isfile(os.path.join("models", "index", categories, file)):
-                        if file.endswith(f"{model_name}_v1.index") or file.endswith(f"{model_name}_v2.index") or file.endswith(f"{model_name}.index"):
-                            matching_index_files.append(file)
-                if len(matching_index_files) == 1:
-                    return os.path.join("models", "index", categories, matching_index_files[0])
-                elif len(matching_index_files) > 1:
-                    print(f"Found multiple matching indexes {matching_index_files} for model {model_name}.")
-                    sys.exit(1)
-                else:
-                    print(f"No matching index could be found for model {model_name}.")
-                    sys.exit(1)
-            else:
-                print(f"No matching index could be found for model {model_name}.")
-                sys.exit(1)
+            print(f"No matching index could be found for model {model_name}.")
+            sys.exit(1)
 
     def model_selection_loop(self, dir: str):
         while len(self.model) == 0:
-            dir_contents = os.listdir(dir)
-            dir_contents.sort()
-            models = [path for path in dir_contents if os.path.isfile(os.path.join(dir, path))]
-            categories = [path for path in dir_contents if os.path.isdir(os.path.join(dir, path)) and path != "index"]
+            models, categories = self.get_catalog().listing(dir)
             if len(models) == 0 and len(categories) == 0:
                 print(f"There are no models inside the directory {dir}")
                 sys.exit(1)
@@ -195,7 +214,7 @@ class CLI_Interface:
                     if selection_num < len(models):
                         model_path = os.path.join(dir, models[selection_num])
                         model_name = models[selection_num].split(".")[0]
-                        self.model.append(model_path, self.index_matching(model_name, model_path))
+                        self.model.append((model_path, self.index_matching(model_name, model_path)))
                     else:
                         self.model_selection_loop(os.path.join(dir, categories[selection_num-len(models)]))
                 else:
@@ -203,26 +222,29 @@ class CLI_Interface:
             except ValueError:
                 print("Invalid selection. Try again.")
 
-    def fill_remaining_params(self):
-        # select device
+    def select_device(self):
         while self.device == "":
             print("Select a device to perform inference on.")
             print("[0] cpu")
-            for i in range(torch.cuda.device_count()):
-                name = torch.cuda.get_device_name(i)
+            devices = cuda_devices()
+            for i, name in enumerate(devices):
                 print(f"[{i+1}] cuda:{i} \"{name}\"")
             device_selection = input("> ")
             try:
                 selection_num = int(device_selection)
                 if selection_num == 0:
                     self.device = "cpu"
-                elif selection_num > torch.cuda.device_count() or selection_num < 0:
+                elif selection_num > len(devices) or selection_num < 0:
                     print("Invalid selection. Try again.")
                 else:
                     self.device = f"cuda:{selection_num-1}"
             except ValueError:
                 print("Invalid selection. Try again.")
 
+    def fill_remaining_params(self):
+        # select device
+        self.select_device()
+
         # select model
         self.model_selection_loop("models")
 
@@ -249,7 +271,9 @@ class CLI_Interface:
             print(f"[1] harvest: better bass but extremely slow")
             print(f"[2] crepe: better quality but GPU intensive")
             print(f"[3] rmvpe: best quality and little GPU requirement")
-            options = ["pm", "harvest", "crepe", "rmvpe"]
+            print(f"[4] crepe-tiny: faster crepe with a smaller model")
+            print(f"[5] crepe-fast: crepe-tiny at a quarter of the frame rate, usable on CPU")
+            options = ["pm", "harvest", "crepe", "rmvpe", "crepe-tiny", "crepe-fast"]
             method_selection = input("> ")
             try:
                 selection_num = int(method_selection)
@@ -289,12 +313,43 @@ class CLI_Interface:
 
     # perform inference for all selected files and models
     def perform_inference(self):
+        from rvc.daemon import DaemonClient
+
+        client = DaemonClient(port=self.daemon_port)
+        if client.health() is not None:
+            self.perform_inference_on_daemon(client)
+            return
+
+        from rvc.infer import Engine, InferenceParams
+
+        # the features of an input are only reused by the next model
+        engine = Engine(self.device, self.model_cache_mb, self.feature_cache_disk, self.chunk_context, self.f0_cache_disk, len(self.model) > 1)
         for model, index in self.model:
+            params = InferenceParams(f0_up_key=self.pitch_adjustment, f0_method=self.pitch_extraction_method, file_index=index, skip_silence=self.skip_silence)
             for audio_file in self.audio:
                 model_name = os.path.basename(model).split(".")[0]
                 out_name = os.path.basename(audio_file).split(".")[0]+f"_{model_name}.wav"
                 output_file = os.path.join("out", out_name)
-                infer(self.pitch_adjustment, audio_file, output_file, model, index, self.device, self.pitch_extraction_method)
+                engine.convert_file(audio_file, model, params, output_file)
+
+    # send all jobs to the running daemon which already has the models loaded
+    def perform_inference_on_daemon(self, client):
+        print("Sending jobs to the running daemon.")
+        for model, index in self.model:
+            for audio_file in self.audio:
+                model_name = os.path.basename(model).split(".")[0]
+                out_name = os.path.basename(audio_file).split(".")[0]+f"_{model_name}.wav"
+                output_file = os.path.join("out", out_name)
+                result = client.convert({
+                    "audio": os.path.abspath(audio_file),
+                    "model": os.path.abspath(model),
+                    "index": os.path.abspath(index) if index else "",
+                    "pitch_adjustment": self.pitch_adjustment,
+                    "f0_method": self.pitch_extraction_method,
+                    "skip_silence": self.skip_silence,
+                    "output": os.path.abspath(output_file),
+                })
+                print(f"processed {audio_file} in {result['seconds']:.2f}s")
 
 def folder_check():
     for folder in ["in", "out", "models", os.path.join("models", "index")]:
@@ -309,9 +364,59 @@ def folder_check():
             sys.exit(1)
 
 
+def run_daemon(interface: CLI_Interface):
+    from rvc.daemon import Daemon
+
+    interface.select_device()
+    daemon = Daemon(interface.device, interface.model_cache_mb, interface.feature_cache_disk, interface.chunk_context, interface.f0_cache_disk, port=interface.daemon_port)
+    daemon.warm_up([model for model, _ in interface.model])
+    daemon.serve()
+
+
+def run_autotune(interface: CLI_Interface):
+    from rvc.infer import Config
+    from rvc.lib.autotune import autotune
+
+    interface.select_device()
+    config = Config(interface.device)
+    x_pad, x_query, x_center, x_max = autotune(config)
+    print(f"Converting in chunks of {x_center} seconds on {config.device} from now on.")
+
+
+def run_stream(interface: CLI_Interface, output):
+    from rvc.infer import Engine, InferenceParams
+    from rvc.stream import StreamConverter, stream
+
+    # stdin carries the audio, so nothing can be asked interactively
+    if interface.device == "" or len(interface.model) != 1:
+        print("Streaming needs a device and a single model in settings.json.")
+        sys.exit(1)
+    engine = Engine(interface.device, interface.model_cache_mb, f0_cache_disk=interface.f0_cache_disk)
+    model, index = interface.model[0]
+    params = InferenceParams(
+        f0_up_key=interface.pitch_adjustment or 0,
+        f0_method=interface.pitch_extraction_method or "rmvpe",
+        file_index=index,
+    )
+    converter = StreamConverter(engine, model, params)
+    converter.warm_up()
+    stream(converter, sys.stdin.buffer, output)
+
+
 if __name__ == "__main__":
+    if "--stream" in sys.argv[1:]:
+        # stdout carries the converted audio, everything printed goes to stderr
+        audio_output = sys.stdout.buffer
+        sys.stdout = sys.stderr
     folder_check()
     interface = CLI_Interface()
     interface.load_settings()
-    interface.fill_remaining_params()
-    interface.perform_inference()
+    if "--daemon" in sys.argv[1:]:
+        run_daemon(interface)
+    elif "--autotune" in sys.argv[1:]:
+        run_autotune(interface)
+    elif "--stream" in sys.argv[1:]:
+        run_stream(interface, audio_output)
+    else:
+        interface.fill_remaining_params()
+        interface.perform_inference()
@@ -0,0 +1,173 @@
+"""Local inference daemon and the matching client.
+
+The daemon keeps an `Engine` with HuBERT, RMVPE and recently used voice
+models warm and accepts conversion jobs over HTTP on localhost:
+
+    GET  /health    status, uptime and model cache statistics
+    POST /convert   run a job, see `Daemon.run_job` for the fields
+    POST /shutdown  finish the running job and stop the daemon
+
+Start it with `python main.py --daemon`. While it is running main.py sends
+its jobs to the daemon instead of loading the models itself.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import io
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class Daemon:
+    def __init__(self, device: str, cache_budget_mb: int = None, feature_cache_disk: bool = False, chunk_context: float = None, f0_cache_disk: bool = True, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        from rvc.infer import Engine
+
+        # later jobs often convert the same audio with another model
+        self.engine = Engine(device, cache_budget_mb, feature_cache_disk, chunk_context, f0_cache_disk, feature_cache=True)
+        self.host = host
+        self.port = port
+        self.started = time.time()
+        self.jobs = 0
+        # the models share one device, so jobs run one after another
+        self.lock = threading.Lock()
+        self.server = None
+
+    def warm_up(self, model_paths: list = ()):
+        print("warming up")
+        with self.lock:
+            self.engine.warm_up(model_paths)
+
+    def health(self) -> dict:
+        return {
+            "status": "ok",
+            "device": self.engine.config.device,
+            "uptime": time.time() - self.started,
+            "jobs": self.jobs,
+            "models": self.engine.models.stats(),
+        }
+
+    def run_job(self, job: dict) -> dict:
+        """Convert one file.
+
+        Fields of `job`: `audio` and `model` paths (required), `index` path
+        (looked up in the model catalog if missing), `pitch_adjustment`, `f0_method`, `skip_silence`, `output` path (defaults to the out
+        folder) and `inline` to get the wav file base64 encoded in the
+        response instead of writing it.
+        """
+        from rvc.infer import InferenceParams
+        from scipy.io import wavfile
+
+        for field in ["audio", "model"]:
+            if field not in job:
+                raise ValueError(f"Field '{field}' is missing in the job.")
+        params = InferenceParams(
+            f0_up_key=int(job.get("pitch_adjustment", 0)),
+            f0_method=job.get("f0_method", "rmvpe"),
+            skip_silence=bool(job.get("skip_silence", False)),
+            file_index=job["index"] if "index" in job else self.engine.find_index(job["model"]),
+        )
+        t0 = time.time()
+        with self.lock:
+            tgt_sr, audio_opt = self.engine.convert(job["audio"], job["model"], params)
+            self.jobs += 1
+        result = {"sample_rate": tgt_sr, "seconds": time.time() - t0}
+        if job.get("inline", False):
+            buffer = io.BytesIO()
+            wavfile.write(buffer, tgt_sr, audio_opt)
+            result["audio"] = base64.b64encode(buffer.getvalue()).decode("ascii")
+        else:
+            output_path = job.get("output")
+            if output_path is None:
+                model_name = os.path.basename(job["model"]).split(".")[0]
+                out_name = os.path.basename(job["audio"]).split(".")[0] + f"_{model_name}.wav"
+                output_path = os.path.join("out", out_name)
+            wavfile.write(output_path, tgt_sr, audio_opt)
+            result["output"] = output_path
+        return result
+
+    def serve(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self.send_json(200, daemon.health())
+                else:
+                    self.send_json(404, {"error": f"Unknown endpoint {self.path}."})
+
+            def do_POST(self):
+                if self.path == "/shutdown":
+                    self.send_json(200, {"status": "shutting down"})
+                    daemon.shutdown()
+                elif self.path == "/convert":
+                    try:
+                        length = int(self.headers.get("Content-Length", 0))
+                        job = json.loads(self.rfile.read(length) or b"{}")
+                        self.send_json(200, daemon.run_job(job))
+                    except Exception as e:
+                        traceback.print_exc()
+                        self.send_json(400, {"error": str(e)})
+                else:
+                    self.send_json(404, {"error": f"Unknown endpoint {self.path}."})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, lambda *_: self.shutdown())
+        print(f"daemon listening on http://{self.host}:{self.port}")
+        self.server.serve_forever()
+        self.server.server_close()
+        print("daemon stopped")
+
+    def shutdown(self):
+        def stop():
+            # wait for the running job before stopping the server
+            with self.lock:
+                self.server.shutdown()
+
+        threading.Thread(target=stop, daemon=True).start()
+
+
+class DaemonClient:
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.url = f"http://{host}:{port}"
+
+    def request(self, path: str, body: dict = None, timeout: float = None) -> dict:
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(json.loads(e.read()).get("error", str(e)))
+
+    def health(self) -> dict:
+        """Return the daemon status or None if no daemon is running."""
+        try:
+            return self.request("/health", timeout=0.5)
+        except (OSError, ValueError):
+            return None
+
+    def convert(self, job: dict) -> dict:
+        return self.request("/convert", job)
+
+    def shutdown(self) -> dict:
+        return self.request("/shutdown", {})
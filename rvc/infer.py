@@ -1,6 +1,10 @@
 from scipy.io import wavfile
-from fairseq import checkpoint_utils
 from rvc.lib.audio import load_audio
+from rvc.lib.autotune import load_geometry
+from rvc.lib.cache import fingerprint
+from rvc.lib.feature_cache import FeatureCache
+from rvc.lib.f0_cache import F0Cache
+from rvc.lib.hubert import load_hubert
 from rvc.lib.infer_pack.models import (
     SynthesizerTrnMs256NSFsid,
     SynthesizerTrnMs256NSFsid_nono,
@@ -8,22 +12,41 @@ from rvc.lib.infer_pack.models import (
     SynthesizerTrnMs768NSFsid_nono,
 )
 from rvc.lib.vc_infer_pipeline import VC
+from rvc.lib.index_cache import load_index
+from rvc.lib import model_format
+from rvc.lib.prepare import fold_weight_norm, is_prepared, prepared_path, save_prepared
+from rvc.lib.model_cache import ModelCache, module_nbytes
 from multiprocessing import cpu_count
 import numpy as np
+import os
 import torch
-import sys
 
 
 class Config:
-    def __init__(self, device: str):
+    def __init__(self, device: str, feature_cache_disk: bool = False, f0_cache_disk: bool = True, feature_cache: bool = False):
         self.device = device
         self.is_half = False
         self.n_cpu = 0
         self.gpu_name = None
         self.gpu_mem = None
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
+        # a geometry measured by `python -m rvc.lib.autotune` replaces the guess
+        geometry = load_geometry(self.device, self.is_half)
+        if geometry is not None:
+            self.x_pad, self.x_query, self.x_center, self.x_max = geometry
         self.hubert_model = None
-        self.cpt = None
+        self.model_rmvpe = None
+        # copying the features to the host only pays off if another model or a later run reuses them
+        self.feature_cache = FeatureCache(disk=feature_cache_disk) if feature_cache or feature_cache_disk else None
+        self.f0_cache = F0Cache(disk=f0_cache_disk)
+        self.crepe_memory_mb = 1024
+        self.chunk_batch_size = 0  # chunks per synthesizer call, 0 picks it from free memory
+        # seconds of context per chunk side with cross-faded seams, None pads each chunk by x_pad
+        self.x_context = None
+        # search the index for the next batch of chunks on a worker thread while
+        # the current one is synthesized
+        self.pipeline_retrieval = True
+        self.retrieval_threads = 0  # faiss threads on cpu, 0 leaves a quarter of the cores to it
 
     def device_config(self) -> tuple:
         if torch.cuda.is_available() and self.device != "cpu":
@@ -90,96 +113,243 @@ class Config:
 
         return x_pad, x_query, x_center, x_max
     
-    def load_hubert(self):
-        models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
-            ["rvc/hubert_base.pt"],
-            suffix="",
-        )
-        self.hubert_model = models[0]
-        self.hubert_model = self.hubert_model.to(self.device)
-        if self.is_half:
-            self.hubert_model = self.hubert_model.half()
-        else:
-            self.hubert_model = self.hubert_model.float()
-        self.hubert_model.eval()
+    def load_hubert(self, output_layer: int = 12):
+        if self.hubert_model is not None and self.hubert_model.num_layers >= output_layer:
+            return
+        self.hubert_model = load_hubert("rvc/hubert_base.pt", output_layer, self.device, self.is_half)
+
+    def load_rmvpe(self):
+        from rvc.lib.rmvpe import RMVPE
+
+        print("loading rmvpe model")
+        self.model_rmvpe = RMVPE("rvc/rmvpe.pt", is_half=self.is_half, device=self.device)
 
     def get_vc(self, model_path: str):
+        return VoiceModel(model_path, self)
+
+
+class VoiceModel:
+    def __init__(self, model_path: str, config: Config):
         print("loading model %s" % model_path)
-        self.cpt = torch.load(model_path, map_location="cpu")
-        self.tgt_sr = self.cpt["config"][-1]
-        self.cpt["config"][-3] = self.cpt["weight"]["emb_g.weight"].shape[0]  # n_spk
-        self.if_f0 = self.cpt.get("f0", 1)
-        self.version = self.cpt.get("version", "v1")
+        self.model_path = model_path
+        source_path = model_path
+        if model_format.is_up_to_date(model_path):
+            # a current converted model replaces the checkpoint, prepared copy included
+            source_path = model_format.converted_path(model_path)
+        prepared = is_prepared(source_path)
+        if prepared:
+            metadata, weights = model_format.load_model(prepared_path(source_path))
+            assign = True
+        elif source_path.endswith(model_format.EXTENSION):
+            # memory mapped weights are assigned directly instead of copied
+            metadata, weights = model_format.load_model(source_path)
+            source_half = metadata.get("half", False)
+            assign = True
+        else:
+            cpt = torch.load(model_path, map_location="cpu")
+            metadata, weights = model_format.checkpoint_metadata(cpt), cpt["weight"]
+            source_half = any(weight.dtype == torch.float16 for weight in weights.values())
+            assign = False
+            del cpt
+        self.tgt_sr = metadata["tgt_sr"]
+        self.if_f0 = metadata["f0"]
+        self.version = metadata["version"]
         if self.version == "v1":
             if self.if_f0 == 1:
-                self.net_g = SynthesizerTrnMs256NSFsid(*self.cpt["config"], is_half=self.is_half)
+                self.net_g = SynthesizerTrnMs256NSFsid(*metadata["config"], is_half=config.is_half)
             else:
-                self.net_g = SynthesizerTrnMs256NSFsid_nono(*self.cpt["config"])
+                self.net_g = SynthesizerTrnMs256NSFsid_nono(*metadata["config"])
         elif self.version == "v2":
             if self.if_f0 == 1:
-                self.net_g = SynthesizerTrnMs768NSFsid(*self.cpt["config"], is_half=self.is_half)
+                self.net_g = SynthesizerTrnMs768NSFsid(*metadata["config"], is_half=config.is_half)
             else:
-                self.net_g = SynthesizerTrnMs768NSFsid_nono(*self.cpt["config"])
+                self.net_g = SynthesizerTrnMs768NSFsid_nono(*metadata["config"])
         del self.net_g.enc_q
-        self.net_g.load_state_dict(self.cpt["weight"], strict=False)
-        self.net_g.eval().to(self.device)
-        if self.is_half:
+        if prepared:
+            fold_weight_norm(self.net_g)
+            self.net_g.load_state_dict(weights, assign=assign)
+        else:
+            self.net_g.load_state_dict(weights, strict=False, assign=assign)
+            # fold in full precision even if the weights are stored as float16
+            self.net_g.float()
+            fold_weight_norm(self.net_g)
+            # stored in the precision of the source, so a float16 model stays float16 on disk
+            save_prepared(source_path, metadata, self.net_g, source_half)
+        del weights
+        self.net_g.eval().to(config.device)
+        if config.is_half:
             self.net_g = self.net_g.half()
         else:
             self.net_g = self.net_g.float()
-        self.vc = VC(self.tgt_sr, self)
-
-    def vc_single(self, input_audio_path: str, f0_up_key: int, f0_method: str, file_index: str, model_path: str, output_path: str):
-        sid = 0
-        index_rate = 1
-        filter_radius = 3
-        resample_sr = 0
-        rms_mix_rate = 0
-        protect = 0.33
-
-        self.get_vc(model_path)
-        if input_audio_path is None:
-            print("You need to select an audio file")
-            sys.exit(1)
-
-        audio = load_audio(input_audio_path, 16000)
-        audio_max = np.abs(audio).max() / 0.95
+        self.vc = VC(self.tgt_sr, config)
+        self.file_index = None
+
+    def set_index(self, file_index: str):
+        self.file_index = file_index
+
+    def get_index(self) -> tuple:
+        """The faiss index and retrieval matrix of `file_index`.
+
+        They are owned by the index cache of `rvc.lib.index_cache`, the
+        model only keeps the path so evicting either cache frees them once.
+        """
+        return load_index(self.file_index, self.vc.is_half)
+
+    def nbytes(self) -> int:
+        return module_nbytes(self.net_g)
+
+
+class InferenceParams:
+    def __init__(
+        self,
+        f0_up_key: int = 0,
+        f0_method: str = "rmvpe",
+        file_index: str = "",
+        sid: int = 0,
+        index_rate: float = 1,
+        filter_radius: int = 3,
+        resample_sr: int = 0,
+        rms_mix_rate: float = 0,
+        protect: float = 0.33,
+        skip_silence: bool = False,
+    ):
+        self.f0_up_key = f0_up_key
+        self.f0_method = f0_method
+        self.file_index = file_index
+        self.sid = sid
+        self.index_rate = index_rate
+        self.filter_radius = filter_radius
+        self.resample_sr = resample_sr
+        self.rms_mix_rate = rms_mix_rate
+        self.protect = protect
+        self.skip_silence = skip_silence
+
+    def index_path(self) -> str:
+        """`file_index` without quotes and whitespace, empty if the index isn't used."""
+        if self.index_rate == 0:
+            return ""
+        return self.file_index.strip(" ").strip('"').strip("\n").strip('"').strip(" ").replace("trained", "added")
 
+
+class Engine:
+    """Keeps HuBERT, RMVPE and the voice models resident across conversions.
+
+    Every model is loaded on first use and reused by all following calls to
+    `convert`, so converting many files with many models only pays the load
+    cost once per model. Voice models are kept in a least recently used
+    cache limited to `cache_budget_mb` megabytes, their indexes in the
+    cache of `rvc.lib.index_cache`.
+    """
+
+    def __init__(self, device: str, cache_budget_mb: int = None, feature_cache_disk: bool = False, chunk_context: float = None, f0_cache_disk: bool = True, feature_cache: bool = False):
+        self.config = Config(device, feature_cache_disk, f0_cache_disk, feature_cache)
+        self.config.x_context = chunk_context
+        budget_bytes = None if cache_budget_mb is None else cache_budget_mb * 1024 * 1024
+        self.models = ModelCache(budget_bytes)
+        self.catalog = None
+
+    def find_index(self, model_path: str) -> str:
+        """Look up the index of a model in the catalog, empty if there is none or several."""
+        from rvc.lib.catalog import Catalog
+
+        if self.catalog is None:
+            self.catalog = Catalog("models")
+        else:
+            self.catalog.refresh()
+        model_path = os.path.relpath(model_path)
+        if not self.catalog.is_model(model_path):
+            return ""
+        indexes = self.catalog.find_indexes(model_path)
+        return indexes[0] if len(indexes) == 1 else ""
+
+    def get_model(self, model_path: str, file_index: str = "") -> VoiceModel:
+        key = (model_path, self.config.is_half)
+
+        def loader():
+            voice_model = self.config.get_vc(model_path)
+            voice_model.set_index(file_index)
+            return voice_model, voice_model.nbytes()
+
+        voice_model = self.models.get(key, loader)
+        voice_model.set_index(file_index)
+        return voice_model
+
+    def warm_up(self, model_paths: list = ()):
+        """Load HuBERT, RMVPE and the given voice models and run them once."""
+        self.config.load_hubert()
+        self.config.load_rmvpe()
+        silence = np.zeros(16000, dtype=np.float32)
+        feats = torch.from_numpy(silence).to(self.config.device).view(1, -1)
+        feats = feats.half() if self.config.is_half else feats.float()
+        with torch.no_grad():
+            self.config.hubert_model.extract_features(source=feats, output_layer=12)
+        self.config.model_rmvpe.infer_from_audio(silence, thred=0.03)
+        for model_path in model_paths:
+            self.get_model(model_path)
+
+    def convert(self, audio, model_path: str, params: InferenceParams) -> tuple:
+        """Convert `audio` with the voice model at `model_path`.
+
+        `audio` is either the path of an audio file or a mono float32 array
+        sampled at 16 kHz. Returns the target sample rate and the converted
+        audio as int16 samples.
+        """
+        if isinstance(audio, str):
+            input_audio_path = audio
+            audio = load_audio(audio, 16000)
+        else:
+            audio = np.array(audio, dtype=np.float32)
+            input_audio_path = fingerprint(audio)
+        audio_max = np.abs(audio).max() / 0.95
         if audio_max > 1:
             audio /= audio_max
         times = [0, 0, 0]
 
-        if self.hubert_model == None:
-            self.load_hubert()
-
-        file_index = file_index.strip(" ").strip('"').strip("\n").strip('"').strip(" ").replace("trained", "added")
+        file_index = params.index_path()
 
+        voice_model = self.get_model(model_path, file_index)
+        index, big_npy = voice_model.get_index()
+        self.config.load_hubert(9 if voice_model.version == "v1" else 12)
 
-        audio_opt = self.vc.pipeline(
-            self.hubert_model,
-            self.net_g,
-            sid,
+        audio_opt = voice_model.vc.pipeline(
+            self.config.hubert_model,
+            voice_model.net_g,
+            params.sid,
             audio,
             input_audio_path,
             times,
-            f0_up_key,
-            f0_method,
+            params.f0_up_key,
+            params.f0_method,
             file_index,
-            index_rate,
-            self.if_f0,
-            filter_radius,
-            self.tgt_sr,
-            resample_sr,
-            rms_mix_rate,
-            self.version,
-            protect,
-            None
+            params.index_rate,
+            voice_model.if_f0,
+            params.filter_radius,
+            voice_model.tgt_sr,
+            params.resample_sr,
+            params.rms_mix_rate,
+            voice_model.version,
+            params.protect,
+            None,
+            index,
+            big_npy,
+            params.skip_silence,
         )
-        wavfile.write(output_path, self.tgt_sr, audio_opt)
+        if params.resample_sr >= 16000 and voice_model.tgt_sr != params.resample_sr:
+            return params.resample_sr, audio_opt
+        return voice_model.tgt_sr, audio_opt
+
+    def convert_file(self, input_audio_path: str, model_path: str, params: InferenceParams, output_path: str):
+        tgt_sr, audio_opt = self.convert(input_audio_path, model_path, params)
+        wavfile.write(output_path, tgt_sr, audio_opt)
         print("processed")
 
 
 def infer(transpose_value: int, input_file: str, output_folder: str, model_path: str, index_path: str, device: str, pitch_extraction_method: str):
-    config = Config(device)
-    config.load_hubert()
-    config.vc_single(input_file, transpose_value, pitch_extraction_method, index_path, model_path, output_folder)
+    """Convert a single file, writing the result to the path `output_folder`.
+
+    Kept for backward compatibility only, it loads every model again on each
+    call. Keep an `Engine` around and call `convert_file` instead.
+    """
+    engine = Engine(device)
+    params = InferenceParams(f0_up_key=transpose_value, f0_method=pitch_extraction_method, file_index=index_path)
+    engine.convert_file(input_file, model_path, params, output_folder)
@@ -0,0 +1,175 @@
+"""Chunk geometry tuned to the device.
+
+The pipeline converts long inputs in chunks of `x_center` seconds, cut
+within `x_query` seconds of each multiple, with `x_pad` seconds of context
+on both sides. Instead of guessing these from the GPU name, `autotune` runs
+synthetic chunks of several sizes through HuBERT and a randomly initialized
+synthesizer, measures their throughput and peak memory and stores the
+fastest geometry that fits per device and precision. `Config` picks it up
+on the next start.
+
+    python -m rvc.lib.autotune [--device cuda:0] [--sizes 10 20 30 38 60]
+"""
+import argparse
+import json
+import os
+import platform
+import time
+import torch
+import torch.nn.functional as F
+from rvc.lib.cache import cache_path
+
+DEFAULT_SIZES = [10, 20, 30, 38, 60]
+# share of the gpu memory a chunk may use, the rest is left for the models,
+# the index and batching
+MEMORY_FRACTION = 0.6
+# v2 40k synthesizer, the most common voice model configuration
+V2_40K_CONFIG = [1025, 32, 192, 192, 768, 2, 6, 3, 0, "1", [3, 7, 11], [[1, 3, 5], [1, 3, 5], [1, 3, 5]], [10, 10, 2, 2], 512, [16, 16, 4, 4], 109, 256, 40000]
+
+
+def geometry_path() -> str:
+    return cache_path("geometry.json")
+
+
+def device_key(device: str, is_half: bool) -> str:
+    """Name of the device and precision the geometry is stored under."""
+    if str(device).startswith("cuda"):
+        name = torch.cuda.get_device_name(torch.device(device))
+    else:
+        name = f"{platform.machine()} {platform.processor()} x{os.cpu_count()}".strip()
+    return f"{str(device).split(':')[0]}|{name}|{'half' if is_half else 'float'}"
+
+
+def geometry_for(x_center: int, x_pad: int) -> tuple:
+    """x_pad, x_query, x_center and x_max for chunks of `x_center` seconds."""
+    x_query = max(1, x_center // 6)
+    return x_pad, x_query, x_center, x_center + max(2, x_query // 2)
+
+
+def load_geometry(device: str, is_half: bool) -> tuple:
+    """The stored geometry for the device or None if it wasn't tuned."""
+    path = geometry_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as file:
+            entry = json.load(file).get(device_key(device, is_half))
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    return tuple(entry["geometry"])
+
+
+def save_geometry(device: str, is_half: bool, geometry: tuple, results: list):
+    path = geometry_path()
+    tuned = {}
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as file:
+                tuned = json.load(file)
+        except (OSError, ValueError):
+            tuned = {}
+    tuned[device_key(device, is_half)] = {"geometry": list(geometry), "results": results}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(tuned, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+
+def measure_chunk(config, net_g, seconds: int, runs: int) -> tuple:
+    """Seconds per run and peak memory in bytes of one chunk, like `VC.vc_batch`."""
+    device = config.device
+    dtype = torch.float16 if config.is_half else torch.float32
+    x_pad = config.x_pad if config.x_context is None else config.x_context
+    n_samples = int((seconds + 2 * x_pad) * 16000)
+    source = (torch.randn(1, n_samples) * 0.1).to(device, dtype)
+    padding_mask = torch.zeros(1, n_samples, dtype=torch.bool, device=device)
+    sid = torch.tensor([0], device=device).long()
+    is_cuda = str(device).startswith("cuda")
+    if is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    times = []
+    with torch.no_grad():
+        for _ in range(runs + 1):
+            t0 = time.perf_counter()
+            feats = config.hubert_model.extract_features(source, padding_mask=padding_mask, output_layer=12)[0]
+            feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+            p_len = feats.shape[1]
+            pitch = torch.randint(1, 255, (1, p_len), device=device).long()
+            pitchf = (torch.rand(1, p_len, device=device) * 400 + 100).to(dtype)
+            net_g.infer(feats, torch.tensor([p_len], device=device).long(), pitch, pitchf, sid)
+            if is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - t0)
+    peak = torch.cuda.max_memory_allocated(device) if is_cuda else None
+    # the first run only warms up
+    return sorted(times[1:])[len(times[1:]) // 2], peak
+
+
+def autotune(config, sizes: list = DEFAULT_SIZES, runs: int = 2) -> tuple:
+    """Measure chunk sizes of `sizes` seconds on the device of `config` and store the best."""
+    from rvc.lib.infer_pack.models import SynthesizerTrnMs768NSFsid
+    from rvc.lib.prepare import fold_weight_norm
+
+    config.load_hubert(12)
+    net_g = SynthesizerTrnMs768NSFsid(*V2_40K_CONFIG, is_half=config.is_half)
+    del net_g.enc_q
+    fold_weight_norm(net_g)
+    net_g = net_g.eval().to(config.device)
+    net_g = net_g.half() if config.is_half else net_g.float()
+    limit = None
+    if str(config.device).startswith("cuda"):
+        limit = torch.cuda.get_device_properties(torch.device(config.device)).total_memory * MEMORY_FRACTION
+
+    results = []
+    for seconds in sorted(sizes):
+        try:
+            elapsed, peak = measure_chunk(config, net_g, seconds, runs)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            torch.cuda.empty_cache()
+            print(f"{seconds:3d} s chunks: out of memory")
+            break
+        fits = limit is None or peak <= limit
+        results.append({"seconds": seconds, "throughput": seconds / elapsed, "peak_mb": None if peak is None else peak / 2**20, "fits": fits})
+        peak_text = "" if peak is None else f", peak {peak / 2**20:.0f} MB"
+        print(f"{seconds:3d} s chunks: {seconds / elapsed:6.1f}x realtime{peak_text}{'' if fits else ' (too large)'}")
+        if not fits:
+            break
+    del net_g
+    if str(config.device).startswith("cuda"):
+        torch.cuda.empty_cache()
+    candidates = [result for result in results if result["fits"]]
+    if not candidates:
+        raise RuntimeError(f"None of the chunk sizes {sizes} fit on {config.device}.")
+    # larger chunks need fewer seams, so they win close calls
+    best = max(result["throughput"] for result in candidates)
+    seconds = max(result["seconds"] for result in candidates if result["throughput"] >= 0.95 * best)
+    geometry = geometry_for(seconds, config.x_pad)
+    save_geometry(config.device, config.is_half, geometry, results)
+    return geometry
+
+
+def main():
+    from rvc.infer import Config
+
+    parser = argparse.ArgumentParser(description="Tune the chunk size of the conversion to the device.")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="chunk sizes in seconds to try")
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+
+    config = Config(args.device)
+    x_pad, x_query, x_center, x_max = autotune(config, args.sizes, args.runs)
+    print(f"stored x_pad {x_pad}, x_query {x_query}, x_center {x_center}, x_max {x_max} for {device_key(config.device, config.is_half)}")
+
+
+if __name__ == "__main__":
+    main()
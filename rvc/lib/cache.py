@@ -0,0 +1,24 @@
+import hashlib
+import os
+
+CACHE_DIR = "cache"
+
+
+def cache_path(*parts: str) -> str:
+    """Return a path inside the cache folder, creating its parent folders."""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def path_key(path: str) -> str:
+    """Short stable key for a file path that is safe to use in file names."""
+    return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+
+def fingerprint(array) -> str:
+    """Content hash of a numpy array, including its shape and dtype."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((array.shape, array.dtype.str)).encode("utf-8"))
+    digest.update(memoryview(array.reshape(-1)).cast("B") if array.flags.c_contiguous else array.tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,195 @@
+"""Cached catalog of the voice models and indexes inside the models folder.
+
+The manifest maps every model to its category, index, version, sample rate
+and f0 flag. It is stored as json in the cache folder and refreshed
+incrementally: folders are only listed again when their modification time
+changed and models are only inspected again when their size or
+modification time changed.
+"""
+import json
+import os
+from rvc.lib.cache import cache_path
+
+MANIFEST_VERSION = 1
+MODEL_EXTENSION = ".pth"
+INDEX_EXTENSION = ".index"
+# built by rvc.lib.index_optimizer and used in place of the original index
+OPTIMIZED_EXTENSION = ".opt.index"
+
+
+def index_keys(files: list) -> dict:
+    """Map every model name an index file can belong to onto that file.
+
+    A model matches an index whose name ends with `<model>.index`,
+    `<model>_v1.index` or `<model>_v2.index`, so every suffix of the index
+    name is a key. This turns the matching into a dictionary lookup.
+    """
+    keys = {}
+    for file in files:
+        if not file.endswith(INDEX_EXTENSION) or file.endswith(OPTIMIZED_EXTENSION):
+            continue
+        stem = file[: -len(INDEX_EXTENSION)]
+        bases = {stem}
+        for version in ["_v1", "_v2"]:
+            if stem.endswith(version):
+                bases.add(stem[: -len(version)])
+        for base in bases:
+            for i in range(len(base)):
+                matches = keys.setdefault(base[i:], [])
+                if file not in matches:
+                    matches.append(file)
+    return keys
+
+
+class Catalog:
+    def __init__(self, models_dir: str = "models", manifest_path: str = None):
+        self.models_dir = models_dir
+        self.index_dir = os.path.join(models_dir, "index")
+        self.manifest_path = manifest_path if manifest_path is not None else cache_path("catalog.json")
+        self.dirs = {}
+        self.models = {}
+        self.indexes = {}
+        self.changed = False
+        self.load()
+        self.refresh()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") == MANIFEST_VERSION and manifest.get("models_dir") == self.models_dir:
+            self.dirs = manifest["dirs"]
+            self.models = manifest["models"]
+
+    def save(self):
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "models_dir": self.models_dir,
+            "dirs": self.dirs,
+            "models": self.models,
+        }
+        try:
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(manifest, file, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            print(f"Could not save the model catalog: {e}")
+
+    def scan_dir(self, path: str, seen: set):
+        seen.add(path)
+        mtime = os.stat(path).st_mtime
+        record = self.dirs.get(path)
+        if record is None or record["mtime"] != mtime:
+            subdirs, files = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+            record = {"mtime": mtime, "subdirs": sorted(subdirs), "files": sorted(files)}
+            self.dirs[path] = record
+            self.changed = True
+        for subdir in record["subdirs"]:
+            self.scan_dir(os.path.join(path, subdir), seen)
+
+    def describe(self, model_path: str, stat: os.stat_result) -> dict:
+        from rvc.lib import model_format
+
+        try:
+            metadata = model_format.sniff_model(model_path)
+        except Exception as e:
+            print(f"Could not read the model {model_path}: {e}")
+            metadata = {}
+        category = os.path.relpath(os.path.dirname(model_path), self.models_dir)
+        return {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "name": os.path.basename(model_path).split(".")[0],
+            "category": "" if category == "." else category,
+            "version": metadata.get("version"),
+            "tgt_sr": metadata.get("tgt_sr"),
+            "f0": metadata.get("f0"),
+        }
+
+    def refresh(self):
+        """Bring the manifest up to date with the models folder."""
+        if not os.path.isdir(self.models_dir):
+            return
+        seen = set()
+        self.scan_dir(self.models_dir, seen)
+        for path in list(self.dirs):
+            if path not in seen:
+                del self.dirs[path]
+                self.changed = True
+
+        self.indexes = {}
+        for path in seen:
+            if self.is_index_dir(path):
+                self.indexes[path] = index_keys(self.dirs[path]["files"])
+
+        models = {}
+        for path in seen:
+            if self.is_index_dir(path):
+                continue
+            for file in self.dirs[path]["files"]:
+                if not file.endswith(MODEL_EXTENSION):
+                    continue
+                model_path = os.path.join(path, file)
+                stat = os.stat(model_path)
+                entry = self.models.get(model_path)
+                if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+                    entry = self.describe(model_path, stat)
+                    self.changed = True
+                models[model_path] = entry
+        if len(models) != len(self.models):
+            self.changed = True
+        self.models = models
+        for model_path, entry in self.models.items():
+            indexes = self.find_indexes(model_path)
+            if entry.get("indexes") != indexes:
+                entry["indexes"] = indexes
+                self.changed = True
+        if self.changed:
+            self.save()
+            self.changed = False
+
+    def is_index_dir(self, path: str) -> bool:
+        return path == self.index_dir or path.startswith(self.index_dir + os.path.sep)
+
+    def find_indexes(self, model_path: str) -> list:
+        """Indexes matching the model, first in the index folder, then in its category folder."""
+        entry = self.models[model_path]
+        matches = self.indexes.get(self.index_dir, {}).get(entry["name"], [])
+        if matches:
+            return [os.path.join(self.index_dir, file) for file in matches]
+        if entry["category"] != "":
+            category_dir = os.path.join(self.index_dir, entry["category"])
+            matches = self.indexes.get(category_dir, {}).get(entry["name"], [])
+            return [os.path.join(category_dir, file) for file in matches]
+        return []
+
+    def is_model(self, path: str) -> bool:
+        return path in self.models
+
+    def is_category(self, path: str) -> bool:
+        return path in self.dirs and not self.is_index_dir(path)
+
+    def model_paths(self, path: str = None) -> list:
+        """All models, or all models inside the category folder `path`."""
+        if path is None:
+            path = self.models_dir
+        prefix = path.rstrip(os.path.sep) + os.path.sep
+        return sorted(model_path for model_path in self.models if model_path.startswith(prefix))
+
+    def listing(self, path: str) -> tuple:
+        """Names of the models and categories directly inside `path`."""
+        record = self.dirs.get(path, {"subdirs": [], "files": []})
+        models = [file for file in record["files"] if file.endswith(MODEL_EXTENSION)]
+        categories = [subdir for subdir in record["subdirs"] if not self.is_index_dir(os.path.join(path, subdir))]
+        return models, categories
@@ -0,0 +1,99 @@
+"""Persistent cache of extracted f0 curves.
+
+Entries are keyed by a fingerprint of the audio, the extraction method and
+its parameters. The raw curve in Hz is stored before transposition and
+median filtering, so it can be reused for every pitch adjustment and voice
+model. The most recent curves are also kept in memory, which replaces the
+unbounded per-path dict the pipeline used for harvest. The curves on disk
+are limited to `disk_budget_bytes`, the least recently used ones are
+deleted first.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+from rvc.lib.cache import CACHE_DIR, cache_path
+
+F0_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
+
+class F0Cache:
+    def __init__(self, disk: bool = True, max_entries: int = 32, disk_budget_bytes: int = F0_CACHE_DISK_BYTES):
+        self.disk = disk
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.disk_budget_bytes = disk_budget_bytes
+        # size of the curves on disk, counted on the first write
+        self.disk_bytes = None
+
+    def key(self, fingerprint: str, f0_method: str, params: dict) -> str:
+        description = json.dumps([fingerprint, f0_method, params], sort_keys=True)
+        return hashlib.blake2b(description.encode("utf-8"), digest_size=16).hexdigest()
+
+    def path(self, key: str) -> str:
+        return cache_path("f0", key[:2], key + ".npy")
+
+    def remember(self, key: str, f0: np.ndarray):
+        self.memory[key] = f0
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str) -> np.ndarray:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key].copy()
+        if not self.disk:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        f0 = np.load(path)
+        try:
+            # the modification time orders the curves for pruning
+            os.utime(path)
+        except OSError:
+            pass
+        self.remember(key, f0)
+        return f0.copy()
+
+    def put(self, key: str, f0: np.ndarray):
+        self.remember(key, f0.copy())
+        if not self.disk:
+            return
+        try:
+            path = self.path(key)
+            tmp_path = path[: -len(".npy")] + ".tmp.npy"
+            np.save(tmp_path, f0)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not store the f0 curve on disk: {e}")
+            return
+        if self.disk_bytes is not None:
+            self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes is None or self.disk_bytes > self.disk_budget_bytes:
+            self.prune()
+
+    def prune(self):
+        """Delete the least recently used curves on disk until they fit the budget."""
+        files = []
+        for root, _, names in os.walk(os.path.join(CACHE_DIR, "f0")):
+            for name in names:
+                if name.endswith(".npy") and not name.endswith(".tmp.npy"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        self.disk_bytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.disk_bytes <= self.disk_budget_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
@@ -0,0 +1,185 @@
+"""Segment parallel f0 extraction for the CPU extractors harvest and pm.
+
+The audio is split into segments on the frame grid. Each segment carries
+`overlap` frames of context on both sides and runs on a process pool.
+Only the core frames of every segment are kept, so the stitched curve has
+exactly the frames of a single pass over the whole file.
+
+The workers are spawned instead of forked, since the parent has usually
+initialized torch and CUDA already, which a forked child can hang on.
+
+Run `python -m rvc.lib.f0_parallel` to check both extractors against the
+single pass.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import math
+import multiprocessing
+import numpy as np
+
+MIN_SEGMENT_FRAMES = 1000
+OVERLAP_FRAMES = 100
+# agreement with the single pass: voiced frames within 1%, voicing on 99% of the frames
+F0_TOLERANCE = 0.01
+MIN_AGREEMENT = 0.99
+
+pool = None
+pool_workers = 0
+
+
+def get_pool(n_workers: int) -> ProcessPoolExecutor:
+    global pool, pool_workers
+    if pool is None or pool_workers != n_workers:
+        if pool is not None:
+            pool.shutdown()
+        pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"))
+        pool_workers = n_workers
+    return pool
+
+
+@atexit.register
+def shutdown_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+
+def harvest_segment(x, fs, f0_min, f0_max, frame_period):
+    import pyworld
+
+    f0, t = pyworld.harvest(x, fs=fs, f0_ceil=f0_max, f0_floor=f0_min, frame_period=frame_period)
+    return pyworld.stonemask(x, f0, t, fs)
+
+
+def pm_segment(x, fs, time_step, voicing_threshold, f0_min, f0_max):
+    import parselmouth
+
+    return (
+        parselmouth.Sound(x, fs)
+        .to_pitch_ac(
+            time_step=time_step,
+            voicing_threshold=voicing_threshold,
+            pitch_floor=f0_min,
+            pitch_ceiling=f0_max,
+        )
+        .selected_array["frequency"]
+    )
+
+
+def pm_frames(n_samples: int, fs, time_step, f0_min) -> int:
+    """Number of frames `to_pitch_ac` returns for `n_samples`, rounded like Praat does.
+
+    Praat fits floor((duration - window) / time_step) + 1 frames into the
+    sound, the window being 3 periods of the pitch floor.
+    """
+    return math.floor((n_samples * (1 / fs) - 3.0 / f0_min) / time_step) + 1
+
+
+def segment_frames(total_frames: int, n_workers: int) -> int:
+    return max(MIN_SEGMENT_FRAMES, -(-total_frames // n_workers))
+
+
+def harvest(x, fs, f0_min, f0_max, frame_period, n_workers=1, overlap=OVERLAP_FRAMES) -> np.ndarray:
+    """`pyworld.harvest` followed by `pyworld.stonemask`, split over `n_workers` processes."""
+    x = x.astype(np.double)
+    hop = int(round(fs * frame_period / 1000))
+    total = int(1000 * len(x) / fs / frame_period) + 1
+    size = segment_frames(total, n_workers)
+    if n_workers <= 1 or total <= size:
+        return harvest_segment(x, fs, f0_min, f0_max, frame_period)
+    jobs = []
+    executor = get_pool(n_workers)
+    for start in range(0, total, size):
+        end = min(total, start + size)
+        context_start = max(0, start - overlap)
+        context_end = min(total, end + overlap)
+        segment = x[context_start * hop : context_end * hop]
+        future = executor.submit(harvest_segment, segment, fs, f0_min, f0_max, frame_period)
+        jobs.append((start, end, context_start, future))
+    f0 = np.zeros(total)
+    for start, end, context_start, future in jobs:
+        f0[start:end] = future.result()[start - context_start : end - context_start]
+    return f0
+
+
+def pm(x, fs, time_step, voicing_threshold, f0_min, f0_max, n_workers=1, overlap=OVERLAP_FRAMES) -> np.ndarray:
+    """`parselmouth` autocorrelation pitch, split over `n_workers` processes.
+
+    Segments start on the hop grid and their length has the same remainder
+    modulo the hop as the whole file. Praat centers the analysis frames in
+    the sound, so this keeps the segment frames on the frame grid of the
+    single pass: frame `j` of a segment starting at block `b` is frame
+    `b + j` of the whole file. That holds as long as a segment has as many
+    frames fewer than blocks as the whole file, give or take an even number.
+    When the duration is right at a frame boundary, rounding can make it
+    odd, which moves the frames half a frame off. Such segments get another
+    block of context until it is even again.
+    """
+    hop = int(round(fs * time_step))
+    n_blocks = len(x) // hop
+    remainder = len(x) % hop
+    size = segment_frames(n_blocks, n_workers)
+    if n_workers <= 1 or n_blocks <= size:
+        return pm_segment(x, fs, time_step, voicing_threshold, f0_min, f0_max)
+
+    def parity(blocks):
+        return (blocks - pm_frames(blocks * hop + remainder, fs, time_step, f0_min)) % 2
+
+    jobs = []
+    executor = get_pool(n_workers)
+    for start in range(0, n_blocks, size):
+        context_start = max(0, start - overlap)
+        context_end = start + size + overlap
+        while parity(min(context_end, n_blocks) - context_start) != parity(n_blocks):
+            if context_start > 0:
+                context_start -= 1
+            else:
+                context_end += 1
+        last = context_end >= n_blocks
+        if last:
+            segment = x[context_start * hop :]
+        else:
+            segment = x[context_start * hop : context_end * hop + remainder]
+        future = executor.submit(pm_segment, segment, fs, time_step, voicing_threshold, f0_min, f0_max)
+        jobs.append((start, None if last else start + size, context_start, future))
+        if last:
+            break
+    parts = []
+    for start, end, context_start, future in jobs:
+        segment_f0 = future.result()
+        parts.append(segment_f0[start - context_start : None if end is None else end - context_start])
+    return np.concatenate(parts)
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    fs = 16000
+    t = np.arange(fs * 120) / fs
+    # a vibrato tone interrupted by pauses
+    f0_true = 220 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    x = 0.3 * np.sin(2 * np.pi * np.cumsum(f0_true) / fs) * (np.sin(2 * np.pi * 0.1 * t) > -0.5)
+    x += 0.003 * np.random.RandomState(0).randn(len(x))
+    # more workers than cores still splits the file, so the check runs on any machine
+    n_workers = max(4, os.cpu_count())
+    for name, extract in [
+        ("harvest", lambda n: harvest(x, fs, 50, 1100, 10, n)),
+        ("pm", lambda n: pm(x, fs, 0.01, 0.6, 50, 1100, n)),
+    ]:
+        t0 = time.time()
+        expected = extract(1)
+        t1 = time.time()
+        actual = extract(n_workers)
+        t2 = time.time()
+        assert len(expected) == len(actual), f"{name}: {len(expected)} != {len(actual)} frames"
+        voiced = (expected > 0) & (actual > 0)
+        close = np.mean(np.abs(expected[voiced] - actual[voiced]) <= F0_TOLERANCE * expected[voiced])
+        agree = np.mean((expected > 0) == (actual > 0))
+        print(
+            f"{name}: single {t1 - t0:.2f}s, {n_workers} workers {t2 - t1:.2f}s, "
+            f"voicing agreement {agree:.4f}, voiced frames within {F0_TOLERANCE:.0%} {close:.4f}"
+        )
+        assert agree >= MIN_AGREEMENT, f"{name}: voicing agrees on only {agree:.4f} of the frames"
+        assert close >= MIN_AGREEMENT, f"{name}: only {close:.4f} of the voiced frames are within {F0_TOLERANCE:.0%}"
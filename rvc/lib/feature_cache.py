@@ -0,0 +1,54 @@
+"""Cache of HuBERT features shared by all voice models.
+
+The features of a chunk only depend on the audio, the chunk boundaries and
+the model version (layer 9 with `final_proj` for v1, layer 12 for v2), so
+converting one file with many models only needs one HuBERT pass per chunk
+and version. Features are kept in memory in a least recently used cache
+and can additionally be stored on disk as float16 arrays. Every stored
+chunk costs a copy to the host, so the cache is only created where its
+entries can be reused: in the daemon, for runs with several models, and
+when the features are stored on disk.
+"""
+import os
+import numpy as np
+import torch
+from rvc.lib.cache import cache_path
+from rvc.lib.model_cache import ModelCache
+
+FEATURE_CACHE_BYTES = 512 * 1024 * 1024
+
+
+class FeatureCache:
+    def __init__(self, budget_bytes: int = FEATURE_CACHE_BYTES, disk: bool = False):
+        self.entries = ModelCache(budget_bytes)
+        self.disk = disk
+
+    def key(self, fingerprint: str, start: int, end: int, version: str) -> str:
+        return f"{fingerprint}-{start}-{end}-{version}"
+
+    def disk_path(self, key: str) -> str:
+        return cache_path("features", key[:2], key + ".npy")
+
+    def get(self, key: str, device, dtype) -> torch.Tensor:
+        """Return the cached features on `device` or None."""
+        if key in self.entries:
+            return self.entries.get(key, None).to(device=device, dtype=dtype)
+        if self.disk:
+            path = self.disk_path(key)
+            if os.path.exists(path):
+                feats = torch.from_numpy(np.load(path)).unsqueeze(0)
+                self.put(key, feats, store=False)
+                return feats.to(device=device, dtype=dtype)
+        return None
+
+    def put(self, key: str, feats: torch.Tensor, store: bool = True):
+        feats = feats.detach().cpu()
+        self.entries.get(key, lambda: (feats, feats.numel() * feats.element_size()))
+        if self.disk and store:
+            try:
+                path = self.disk_path(key)
+                tmp_path = path[: -len(".npy")] + ".tmp.npy"
+                np.save(tmp_path, feats[0].half().numpy())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Could not store features on disk: {e}")
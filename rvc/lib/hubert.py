@@ -0,0 +1,333 @@
+"""Self-contained HuBERT base feature extractor.
+
+Loads the fairseq checkpoint `rvc/hubert_base.pt` without importing fairseq
+and only builds the transformer layers that are needed for the requested
+output layer (9 for v1 models, 12 for v2 models).
+
+Run `python -m rvc.lib.hubert` to compare the features against the fairseq
+implementation, which needs fairseq to be installed.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_CONFIG = {
+    "extractor_mode": "default",
+    "conv_feature_layers": "[(512,10,5)] + [(512,3,2)] * 4 + [(512,2,2)] * 2",
+    "conv_bias": False,
+    "encoder_layers": 12,
+    "encoder_embed_dim": 768,
+    "encoder_ffn_embed_dim": 3072,
+    "encoder_attention_heads": 12,
+    "conv_pos": 128,
+    "conv_pos_groups": 16,
+    "layer_norm_first": False,
+    "final_dim": 256,
+}
+
+
+class Fp32GroupNorm(nn.GroupNorm):
+    def forward(self, input, lengths=None):
+        if lengths is not None:
+            return self.masked_forward(input, lengths)
+        output = F.group_norm(
+            input.float(),
+            self.num_groups,
+            self.weight.float() if self.weight is not None else None,
+            self.bias.float() if self.bias is not None else None,
+            self.eps,
+        )
+        return output.type_as(input)
+
+    def masked_forward(self, input, lengths):
+        """Per channel normalization over the first `lengths` frames of each item.
+
+        Padded batches get the statistics of the unpadded input, only the
+        per channel form (num_groups == num_channels) used by HuBERT is supported.
+        """
+        assert self.num_groups == self.num_channels
+        x = input.float()
+        mask = (torch.arange(x.shape[-1], device=x.device)[None] < lengths[:, None]).unsqueeze(1)
+        n = lengths.to(x.dtype)[:, None, None]
+        mean = (x * mask).sum(-1, keepdim=True) / n
+        var = (((x - mean) * mask) ** 2).sum(-1, keepdim=True) / n
+        output = (x - mean) / torch.sqrt(var + self.eps)
+        if self.weight is not None:
+            output = output * self.weight.float()[None, :, None] + self.bias.float()[None, :, None]
+        return output.type_as(input)
+
+
+class SamePad(nn.Module):
+    def __init__(self, kernel_size):
+        super().__init__()
+        self.remove = 1 if kernel_size % 2 == 0 else 0
+
+    def forward(self, x):
+        if self.remove > 0:
+            x = x[:, :, : -self.remove]
+        return x
+
+
+class ConvFeatureExtraction(nn.Module):
+    def __init__(self, conv_layers, conv_bias=False):
+        super().__init__()
+        self.conv_layers = nn.ModuleList()
+        in_d = 1
+        for i, (dim, k, stride) in enumerate(conv_layers):
+            if i == 0:
+                block = nn.Sequential(
+                    nn.Conv1d(in_d, dim, k, stride=stride, bias=conv_bias),
+                    nn.Dropout(0.0),
+                    Fp32GroupNorm(dim, dim, affine=True),
+                    nn.GELU(),
+                )
+            else:
+                block = nn.Sequential(
+                    nn.Conv1d(in_d, dim, k, stride=stride, bias=conv_bias),
+                    nn.Dropout(0.0),
+                    nn.GELU(),
+                )
+            self.conv_layers.append(block)
+            in_d = dim
+
+    def forward(self, x, lengths=None):
+        """`lengths` holds the unpadded number of samples of each item in a padded batch."""
+        # BxT -> BxCxT
+        x = x.unsqueeze(1)
+        for block in self.conv_layers:
+            if lengths is None:
+                x = block(x)
+                continue
+            for layer in block:
+                if isinstance(layer, Fp32GroupNorm):
+                    x = layer(x, lengths)
+                else:
+                    x = layer(x)
+                if isinstance(layer, nn.Conv1d):
+                    lengths = (lengths - layer.kernel_size[0]) // layer.stride[0] + 1
+        return x
+
+    def output_lengths(self, lengths):
+        for block in self.conv_layers:
+            conv = block[0]
+            lengths = (lengths - conv.kernel_size[0]) // conv.stride[0] + 1
+        return lengths
+
+
+class TransformerLayer(nn.Module):
+    def __init__(self, embed_dim, ffn_embed_dim, num_heads):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.self_attn = nn.Module()
+        self.self_attn.q_proj = nn.Linear(embed_dim, embed_dim)
+        self.self_attn.k_proj = nn.Linear(embed_dim, embed_dim)
+        self.self_attn.v_proj = nn.Linear(embed_dim, embed_dim)
+        self.self_attn.out_proj = nn.Linear(embed_dim, embed_dim)
+        self.self_attn_layer_norm = nn.LayerNorm(embed_dim)
+        self.fc1 = nn.Linear(embed_dim, ffn_embed_dim)
+        self.fc2 = nn.Linear(ffn_embed_dim, embed_dim)
+        self.final_layer_norm = nn.LayerNorm(embed_dim)
+
+    def forward(self, x, padding_mask=None):
+        # x: T x B x C, identical to the fused attention path used by fairseq
+        attn = self.self_attn
+        residual = x
+        x, _ = F.multi_head_attention_forward(
+            x,
+            x,
+            x,
+            self.embed_dim,
+            self.num_heads,
+            torch.empty([0]),
+            torch.cat((attn.q_proj.bias, attn.k_proj.bias, attn.v_proj.bias)),
+            None,
+            None,
+            False,
+            0.0,
+            attn.out_proj.weight,
+            attn.out_proj.bias,
+            False,
+            key_padding_mask=padding_mask,
+            need_weights=False,
+            use_separate_proj_weight=True,
+            q_proj_weight=attn.q_proj.weight,
+            k_proj_weight=attn.k_proj.weight,
+            v_proj_weight=attn.v_proj.weight,
+        )
+        x = self.self_attn_layer_norm(residual + x)
+        residual = x
+        x = F.gelu(self.fc1(x).float()).type_as(x)
+        x = self.fc2(x)
+        x = self.final_layer_norm(residual + x)
+        return x
+
+
+class TransformerEncoder(nn.Module):
+    def __init__(self, cfg, num_layers):
+        super().__init__()
+        embed_dim = cfg["encoder_embed_dim"]
+        self.pos_conv = nn.Sequential(
+            nn.Conv1d(
+                embed_dim,
+                embed_dim,
+                kernel_size=cfg["conv_pos"],
+                padding=cfg["conv_pos"] // 2,
+                groups=cfg["conv_pos_groups"],
+            ),
+            SamePad(cfg["conv_pos"]),
+            nn.GELU(),
+        )
+        self.layer_norm = nn.LayerNorm(embed_dim)
+        self.layers = nn.ModuleList(
+            [
+                TransformerLayer(embed_dim, cfg["encoder_ffn_embed_dim"], cfg["encoder_attention_heads"])
+                for _ in range(num_layers)
+            ]
+        )
+
+    def forward(self, x, padding_mask=None, num_layers=None):
+        if padding_mask is not None:
+            x = x.masked_fill(padding_mask.unsqueeze(-1), 0)
+        x_conv = self.pos_conv(x.transpose(1, 2)).transpose(1, 2)
+        x = self.layer_norm(x + x_conv)
+        # B x T x C -> T x B x C
+        x = x.transpose(0, 1)
+        for layer in self.layers[:num_layers]:
+            x = layer(x, padding_mask)
+        return x.transpose(0, 1)
+
+
+class HubertModel(nn.Module):
+    def __init__(self, cfg, num_layers=None):
+        super().__init__()
+        if cfg["extractor_mode"] != "default" or cfg["layer_norm_first"]:
+            raise ValueError("Only HuBERT base checkpoints are supported.")
+        conv_layers = eval(cfg["conv_feature_layers"])
+        self.num_layers = cfg["encoder_layers"] if num_layers is None else num_layers
+        self.embed = conv_layers[-1][0]
+        self.feature_extractor = ConvFeatureExtraction(conv_layers, cfg["conv_bias"])
+        self.layer_norm = nn.LayerNorm(self.embed)
+        self.post_extract_proj = nn.Linear(self.embed, cfg["encoder_embed_dim"])
+        self.encoder = TransformerEncoder(cfg, self.num_layers)
+        self.final_proj = nn.Linear(cfg["encoder_embed_dim"], cfg["final_dim"])
+
+    def forward_padding_mask(self, features, padding_mask):
+        extra = padding_mask.size(1) % features.size(1)
+        if extra > 0:
+            padding_mask = padding_mask[:, :-extra]
+        padding_mask = padding_mask.view(padding_mask.size(0), features.size(1), -1)
+        return padding_mask.all(-1)
+
+    def extract_features(self, source, padding_mask=None, mask=False, ret_conv=False, output_layer=None, lengths=None):
+        """Mirrors `fairseq.models.hubert.HubertModel.extract_features` for inference.
+
+        Unlike fairseq, padded items of a batch give the same features as
+        on their own: the group norm ignores the padding and the returned
+        frame padding mask follows the convolution lengths. Callers that
+        know the unpadded `lengths` of a padded batch pass them, otherwise
+        they are read from `padding_mask`, which waits for the device.
+        """
+        if output_layer is None:
+            output_layer = self.num_layers
+        if output_layer > self.num_layers:
+            raise ValueError(f"Layer {output_layer} requested but only {self.num_layers} layers were loaded.")
+        if lengths is None and padding_mask is not None and padding_mask.any():
+            lengths = (~padding_mask).sum(-1)
+        features = self.feature_extractor(source, lengths)
+        features = features.transpose(1, 2)
+        features = self.layer_norm(features)
+        if lengths is not None:
+            frames = self.feature_extractor.output_lengths(lengths)
+            padding_mask = torch.arange(features.shape[1], device=features.device)[None] >= frames[:, None]
+        elif padding_mask is not None:
+            padding_mask = self.forward_padding_mask(features, padding_mask)
+        features = self.post_extract_proj(features)
+        x = self.encoder(features, padding_mask, output_layer)
+        return x, padding_mask
+
+
+def _model_config(ckpt) -> dict:
+    cfg = dict(DEFAULT_CONFIG)
+    source = None
+    if ckpt.get("cfg") is not None:
+        source = ckpt["cfg"]["model"]
+    elif ckpt.get("args") is not None:
+        source = vars(ckpt["args"])
+    if source is not None:
+        for key in cfg:
+            if key in source and source[key] is not None:
+                cfg[key] = source[key]
+    return cfg
+
+
+def _inference_state_dict(state, num_layers) -> dict:
+    weights = {}
+    for name, tensor in state.items():
+        if name.startswith("encoder.layers."):
+            if int(name.split(".")[2]) >= num_layers:
+                continue
+        weights[name] = tensor
+    # fold the weight norm of the positional convolution
+    prefix = "encoder.pos_conv.0."
+    if prefix + "weight_g" in weights:
+        g, v = weights.pop(prefix + "weight_g"), weights.pop(prefix + "weight_v")
+    else:
+        g = weights.pop(prefix + "parametrizations.weight.original0")
+        v = weights.pop(prefix + "parametrizations.weight.original1")
+    weights[prefix + "weight"] = v * (g / v.norm(dim=(0, 1), keepdim=True))
+    return weights
+
+
+def load_hubert(model_path, output_layer=None, device="cpu", is_half=False) -> HubertModel:
+    """Load the HuBERT base checkpoint with the layers up to `output_layer`."""
+    ckpt = torch.load(model_path, map_location="cpu")
+    cfg = _model_config(ckpt)
+    model = HubertModel(cfg, output_layer)
+    weights = _inference_state_dict(ckpt["model"], model.num_layers)
+    del ckpt
+    missing, _ = model.load_state_dict(weights, strict=False)
+    if missing:
+        raise RuntimeError(f"Missing weights in {model_path}: {missing}")
+    model = model.to(device)
+    model = model.half() if is_half else model.float()
+    return model.eval()
+
+
+if __name__ == "__main__":
+    from fairseq import checkpoint_utils
+
+    model_path = "rvc/hubert_base.pt"
+    models, _, _ = checkpoint_utils.load_model_ensemble_and_task([model_path], suffix="")
+    reference = models[0].float().eval()
+    torch.manual_seed(0)
+    source = torch.randn(1, 16000 * 5) * 0.1
+    padding_mask = torch.zeros_like(source, dtype=torch.bool)
+    for output_layer, version in [(9, "v1"), (12, "v2")]:
+        model = load_hubert(model_path, output_layer)
+        with torch.no_grad():
+            expected = reference.extract_features(source, padding_mask=padding_mask, output_layer=output_layer)[0]
+            actual = model.extract_features(source, padding_mask=padding_mask, output_layer=output_layer)[0]
+            if version == "v1":
+                expected = reference.final_proj(expected)
+                actual = model.final_proj(actual)
+        diff = (expected - actual).abs().max().item()
+        print(f"{version} layer {output_layer}: max abs difference {diff:.2e}")
+        assert diff < 1e-4, f"{version} features do not match fairseq"
+
+    # items of a padded batch should match their unbatched features
+    model = load_hubert(model_path, 12)
+    lengths = [16000 * 5, 16000 * 3 + 123]
+    batch = torch.zeros(len(lengths), max(lengths))
+    for i, length in enumerate(lengths):
+        batch[i, :length] = source[0, :length]
+    padding_mask = torch.arange(batch.shape[1])[None] >= torch.tensor(lengths)[:, None]
+    with torch.no_grad():
+        batched, frame_mask = model.extract_features(batch, padding_mask=padding_mask)
+        for i, length in enumerate(lengths):
+            single = model.extract_features(source[:, :length], padding_mask=torch.zeros(1, length, dtype=torch.bool))[0]
+            n_frames = int((~frame_mask[i]).sum())
+            assert n_frames == single.shape[1], "frame count of the padded item differs"
+            diff = (batched[i, :n_frames] - single[0]).abs().max().item()
+            print(f"batch item {i}: max abs difference {diff:.2e}")
+            assert diff < 1e-4, "padded batch features do not match"
@@ -0,0 +1,108 @@
+"""Cached loading of faiss indexes and their retrieval matrices.
+
+The matrix of all index vectors (`big_npy`) is reconstructed once and stored
+next to the index as a `.npy` file that is memory mapped on later loads.
+It is rebuilt whenever the modification time or size of the index changes.
+Loaded indexes are kept in process so following files reuse them.
+An optimized version of the index built by `rvc.lib.index_optimizer` is
+searched instead of the original while the original stays unchanged.
+"""
+import json
+import os
+import traceback
+import numpy as np
+from rvc.lib.catalog import OPTIMIZED_EXTENSION
+from rvc.lib.model_cache import ModelCache, index_nbytes
+
+INDEX_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+indexes = ModelCache(INDEX_CACHE_BYTES)
+
+
+def index_stamp(file_index: str) -> dict:
+    stat = os.stat(file_index)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def optimized_path(file_index: str) -> str:
+    return os.path.splitext(file_index)[0] + OPTIMIZED_EXTENSION
+
+
+def is_optimized(file_index: str) -> bool:
+    """Whether `file_index` has an optimized version built from its current content."""
+    path = optimized_path(file_index)
+    if not os.path.exists(path) or not os.path.exists(path + ".json"):
+        return False
+    try:
+        with open(path + ".json", "r") as file:
+            return json.load(file)["stamp"] == index_stamp(file_index)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def big_npy_path(file_index: str, half: bool = False) -> str:
+    return os.path.splitext(file_index)[0] + (".big.f16.npy" if half else ".big.npy")
+
+
+def load_big_npy(file_index: str, index=None, half: bool = False) -> np.ndarray:
+    """The retrieval matrix of `file_index`, `index` is the loaded original if at hand."""
+    path = big_npy_path(file_index, half)
+    stamp_path = path + ".json"
+    stamp = index_stamp(file_index)
+    if os.path.exists(path) and os.path.exists(stamp_path):
+        with open(stamp_path, "r") as file:
+            if json.load(file) == stamp:
+                return np.load(path, mmap_mode="r")
+    if index is None:
+        import faiss
+
+        index = faiss.read_index(file_index)
+    big_npy = index.reconstruct_n(0, index.ntotal)
+    if half:
+        big_npy = big_npy.astype(np.float16)
+    try:
+        tmp_path = path[: -len(".npy")] + ".tmp.npy"
+        np.save(tmp_path, big_npy)
+        os.replace(tmp_path, path)
+        with open(stamp_path, "w") as file:
+            json.dump(stamp, file)
+    except OSError as e:
+        print(f"Could not store the retrieval matrix of {file_index}: {e}")
+        return big_npy
+    return np.load(path, mmap_mode="r")
+
+
+def load_index(file_index: str, half: bool = False) -> tuple:
+    """Return the faiss index and retrieval matrix of `file_index`.
+
+    Returns `(None, None)` if there is no index or it cannot be read.
+    """
+    if file_index == "" or os.path.exists(file_index) == False:
+        return None, None
+    key = (os.path.abspath(file_index), half)
+    optimized = is_optimized(file_index)
+    stamp = dict(index_stamp(file_index), optimized=optimized)
+    if key in indexes:
+        cached_stamp, index, big_npy = indexes.get(key, None)
+        if cached_stamp == stamp:
+            return index, big_npy
+        indexes.pop(key)
+
+    def loader():
+        import faiss
+
+        if optimized:
+            # the ids of the optimized index are the rows of the original matrix
+            index = faiss.read_index(optimized_path(file_index))
+            big_npy = load_big_npy(file_index, None, half)
+        else:
+            index = faiss.read_index(file_index)
+            big_npy = load_big_npy(file_index, index, half)
+        return (stamp, index, big_npy), index_nbytes(index, None)
+
+    try:
+        _, index, big_npy = indexes.get(key, loader)
+    except:
+        traceback.print_exc()
+        return None, None
+    return index, big_npy
@@ -0,0 +1,229 @@
+"""Approximate nearest neighbour versions of the retrieval indexes.
+
+The indexes shipped with voice models are usually flat or coarse IVF
+indexes, searched for the 8 nearest neighbours of every HuBERT frame. This
+tool rebuilds an index as an HNSW graph or an IVF-PQ index, optionally
+behind a PCA, and tunes its search depth (`efSearch` or `nprobe`) to the
+lowest value that reaches the recall target. PQ codes and PCA only
+approximate the distances the retrieval weights are computed from, so those
+indexes rank their candidates again on the full vectors. The result is
+stored as `<name>.opt.index` next to the original and used by `load_index`
+instead of it for as long as the original doesn't change. The retrieval
+matrix is still taken from the original, the ids of both indexes are the
+same.
+
+Recall@8 and speed are measured on held out rows of the index: they are
+left out of the candidates, which are trained on and filled with the other
+rows, and searched against them. The original is searched with the query
+row itself removed from the results. The stored index is the chosen
+candidate filled with all rows. Indexes with too few rows to hold out
+queries or to train a candidate are skipped.
+
+    python -m rvc.lib.index_optimizer models/index [--kind auto|hnsw|ivfpq] [--recall 0.9] [--pca 0]
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+from rvc.lib.catalog import OPTIMIZED_EXTENSION
+from rvc.lib.index_cache import index_stamp, is_optimized, load_big_npy, optimized_path
+
+KINDS = ["hnsw", "ivfpq"]
+HNSW_NEIGHBOURS = 32
+EF_SEARCH = [16, 24, 32, 48, 64, 96, 128, 192, 256]
+NPROBE = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+N_QUERIES = 2000
+K = 8
+# rows needed to train a candidate, PQ clusters every subvector into 256 centroids
+MIN_TRAIN_ROWS = {"hnsw": 1, "ivfpq": 256}
+
+
+def factory_string(kind: str, n_vectors: int, d: int, pca: int) -> str:
+    prefix = f"PCA{pca}," if pca else ""
+    d = pca or d
+    if kind == "hnsw":
+        # the graph keeps the full vectors, unless they went through the PCA
+        return f"{prefix}HNSW{HNSW_NEIGHBOURS}" + (",RFlat" if pca else "")
+    # about 4 sqrt(n) lists with at least 39 training rows each, 8 dimensions per byte
+    nlist = int(max(1, min(4 * np.sqrt(n_vectors), n_vectors // 39)))
+    m = max(1, d // 8)
+    while d % m:
+        m -= 1
+    return f"{prefix}IVF{nlist},PQ{m},RFlat"
+
+
+def search_parameter(kind: str) -> tuple:
+    """Name and tried values of the search depth of `kind`."""
+    return ("efSearch", EF_SEARCH) if kind == "hnsw" else ("nprobe", NPROBE)
+
+
+def ground_truth(rows, queries, k: int) -> np.ndarray:
+    """Ids of the exact `k` nearest `rows` of every query."""
+    import faiss
+
+    flat = faiss.IndexFlatL2(rows.shape[1])
+    flat.add(rows)
+    _, ix = flat.search(queries, k)
+    return ix
+
+
+def drop_self(ix, query_ids) -> np.ndarray:
+    """The first `K` ids of every row of `ix` that aren't the query itself."""
+    keep = ix != query_ids[:, None]
+    # rows without the query lose their last id instead
+    keep[keep.all(axis=1), -1] = False
+    return ix[keep].reshape(ix.shape[0], -1)[:, :K]
+
+
+def recall(ix, truth) -> float:
+    hits = sum(len(np.intersect1d(found[found >= 0], expected)) for found, expected in zip(ix, truth))
+    return hits / truth.size
+
+
+def measure(index, queries, truth, query_ids=None, runs: int = 3) -> tuple:
+    """Recall@8 and median seconds of searching all queries.
+
+    Pass `query_ids` when the index holds the query rows, to leave them out of the results.
+    """
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        _, ix = index.search(queries, K if query_ids is None else K + 1)
+        times.append(time.perf_counter() - t0)
+    if query_ids is not None:
+        ix = drop_self(ix, query_ids)
+    return recall(ix, truth), sorted(times)[len(times) // 2]
+
+
+def build(kind: str, rows, pca: int):
+    """A `kind` index trained on and filled with `rows`."""
+    import faiss
+
+    d = rows.shape[1]
+    factory = factory_string(kind, rows.shape[0], d, pca)
+    index = faiss.index_factory(d, factory)
+    if not index.is_trained:
+        index.train(rows)
+    index.add(rows)
+    return index, factory
+
+
+def fill(kind: str, index, big_npy, result: dict):
+    """Copy of the trained `index` holding all rows of `big_npy` in order, searched as tuned in `result`."""
+    import faiss
+
+    filled = faiss.clone_index(index)
+    filled.reset()
+    # in order, so the ids are the rows of the retrieval matrix like in the original
+    filled.add(big_npy)
+    name, _ = search_parameter(kind)
+    faiss.ParameterSpace().set_index_parameter(filled, name, result[name])
+    return filled
+
+
+def tune(kind: str, index, queries, truth, target: float) -> dict:
+    """The smallest search depth that reaches `target`, or the largest one tried."""
+    import faiss
+
+    name, values = search_parameter(kind)
+    parameters = faiss.ParameterSpace()
+    result = None
+    for value in values:
+        parameters.set_index_parameter(index, name, value)
+        found, seconds = measure(index, queries, truth)
+        result = {name: value, "recall": found, "seconds": seconds}
+        if found >= target:
+            break
+    parameters.set_index_parameter(index, name, result[name])
+    return result
+
+
+def optimize(file_index: str, kinds: list = KINDS, target: float = 0.9, pca: int = 0, seed: int = 0) -> dict:
+    """Build, tune and store the optimized version of `file_index`, returns the report.
+
+    Returns None if the index is too small for any of `kinds`.
+    """
+    import faiss
+
+    original = faiss.read_index(file_index)
+    big_npy = np.ascontiguousarray(load_big_npy(file_index, original), dtype=np.float32)
+    n_queries = min(N_QUERIES, big_npy.shape[0] // 10)
+    if n_queries == 0:
+        print(f"{file_index}: skipped, {big_npy.shape[0]} rows are too few to hold out queries")
+        return None
+    rng = np.random.default_rng(seed)
+    query_ids = np.sort(rng.choice(big_npy.shape[0], n_queries, replace=False))
+    train_ids = np.setdiff1d(np.arange(big_npy.shape[0]), query_ids)
+    queries = big_npy[query_ids]
+    train_rows = big_npy[train_ids]
+    truth = drop_self(ground_truth(big_npy, queries, K + 1), query_ids)
+    base_recall, base_seconds = measure(original, queries, truth, query_ids)
+    report = {"original": {"recall": base_recall, "seconds": base_seconds}, "candidates": []}
+
+    # the candidates don't hold the queries, their results are positions in `train_rows`
+    held_out_truth = ground_truth(train_rows, queries, K)
+    best = None
+    for kind in kinds:
+        if train_ids.shape[0] < MIN_TRAIN_ROWS[kind]:
+            print(f"{file_index}: skipped {kind}, {train_ids.shape[0]} training rows are fewer than {MIN_TRAIN_ROWS[kind]}")
+            continue
+        index, factory = build(kind, train_rows, pca)
+        result = dict(tune(kind, index, queries, held_out_truth, target), factory=factory)
+        report["candidates"].append(result)
+        # the fastest index that reaches the target, otherwise the most accurate
+        key = (result["recall"] >= target, -result["seconds"] if result["recall"] >= target else result["recall"])
+        if best is None or key > best[0]:
+            best = (key, kind, index, result)
+    if best is None:
+        return None
+    _, kind, index, result = best
+    if result["recall"] < target:
+        print(f"{file_index}: no candidate reached recall {target}, keeping the most accurate one")
+    path = optimized_path(file_index)
+    tmp_path = path + ".tmp"
+    faiss.write_index(fill(kind, index, big_npy, result), tmp_path)
+    os.replace(tmp_path, path)
+    report["chosen"] = result
+    with open(path + ".json", "w") as file:
+        json.dump({"stamp": index_stamp(file_index), "report": report}, file, indent=4)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build approximate nearest neighbour versions of retrieval indexes.")
+    parser.add_argument("paths", nargs="+", help="index files or directories containing indexes")
+    parser.add_argument("--kind", choices=["auto"] + KINDS, default="auto", help="index structure, auto tries all")
+    parser.add_argument("--recall", type=float, default=0.9, help="recall@8 target on held out rows")
+    parser.add_argument("--pca", type=int, default=0, help="reduce the vectors to this many dimensions first")
+    parser.add_argument("--force", action="store_true", help="rebuild indexes that are already optimized")
+    args = parser.parse_args()
+
+    index_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in files:
+                    if file.endswith(".index") and not file.endswith(OPTIMIZED_EXTENSION):
+                        index_paths.append(os.path.join(root, file))
+        else:
+            index_paths.append(path)
+    kinds = KINDS if args.kind == "auto" else [args.kind]
+    for file_index in index_paths:
+        if not args.force and is_optimized(file_index):
+            print(f"{file_index} is already optimized.")
+            continue
+        report = optimize(file_index, kinds, args.recall, args.pca)
+        if report is None:
+            continue
+        original = report["original"]
+        print(f"{file_index}: original recall@8 {original['recall']:.3f}, {original['seconds'] * 1000:.1f} ms")
+        for result in report["candidates"]:
+            speedup = original["seconds"] / result["seconds"]
+            settings = ", ".join(f"{name} {result[name]}" for name in ["efSearch", "nprobe"] if name in result)
+            print(f"  {result['factory']} ({settings}): recall@8 {result['recall']:.3f}, {result['seconds'] * 1000:.1f} ms, {speedup:.1f}x")
+        print(f"  stored {report['chosen']['factory']} as {optimized_path(file_index)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+import torch
+
+
+def module_nbytes(module: torch.nn.Module) -> int:
+    nbytes = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+def index_nbytes(index, big_npy) -> int:
+    nbytes = 0
+    if index is not None:
+        # the codes of flat and ivf indexes take about as much space as the vectors
+        nbytes += index.ntotal * index.d * 4
+    if big_npy is not None:
+        nbytes += big_npy.nbytes
+    return nbytes
+
+
+class ModelCache:
+    """Least recently used cache with a memory budget.
+
+    Every entry is stored together with its size in bytes. Once the sum of
+    all sizes exceeds `budget_bytes` the least recently used entries are
+    dropped until the cache fits again. The most recently inserted entry is
+    never evicted so a single model larger than the budget still works.
+    """
+
+    def __init__(self, budget_bytes: int = None):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, loader):
+        """Return the entry for `key`, calling `loader` on a miss.
+
+        `loader` returns a tuple of the value and its size in bytes.
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value, nbytes = loader()
+        self.entries[key] = value
+        self.sizes[key] = nbytes
+        self.total_bytes += nbytes
+        self.evict()
+        return value
+
+    def resize(self, key, nbytes: int):
+        self.total_bytes += nbytes - self.sizes[key]
+        self.sizes[key] = nbytes
+        self.evict()
+
+    def pop(self, key):
+        self.total_bytes -= self.sizes.pop(key)
+        return self.entries.pop(key)
+
+    def evict(self):
+        if self.budget_bytes is None:
+            return
+        evicted = False
+        while self.total_bytes > self.budget_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self.pop(key)
+            self.evictions += 1
+            evicted = True
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
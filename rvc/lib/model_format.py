@@ -0,0 +1,172 @@
+"""Memory mapped storage format for RVC voice models.
+
+A converted model is a single file made of
+
+    magic (8 bytes) | header length (8 bytes, little endian) | json header | tensor data
+
+The json header holds the model metadata (config, sample rate, version and
+f0 flag) together with the dtype, shape and offset of every tensor. Reading
+the metadata only touches the first few kilobytes of the file, and the
+tensors are memory mapped so their pages are only read once they are used.
+
+Convert a model or a whole directory of models with
+
+    python -m rvc.lib.model_format models [--half]
+"""
+import argparse
+import json
+import os
+import struct
+import numpy as np
+import torch
+
+MAGIC = b"RVCMMAP1"
+ALIGNMENT = 64
+EXTENSION = ".rvc"
+
+DTYPES = {
+    "float32": (torch.float32, np.float32),
+    "float16": (torch.float16, np.float16),
+    "float64": (torch.float64, np.float64),
+    "int64": (torch.int64, np.int64),
+    "int32": (torch.int32, np.int32),
+}
+TORCH_TO_NAME = {torch_dtype: name for name, (torch_dtype, _) in DTYPES.items()}
+
+
+def converted_path(model_path: str) -> str:
+    return os.path.splitext(model_path)[0] + EXTENSION
+
+
+def is_up_to_date(model_path: str) -> bool:
+    """Whether the converted sibling of `model_path` exists and is not older than it."""
+    fast_path = converted_path(model_path)
+    if fast_path == model_path or not os.path.exists(fast_path):
+        return False
+    return os.path.getmtime(fast_path) >= os.path.getmtime(model_path)
+
+
+def checkpoint_metadata(cpt: dict) -> dict:
+    config = list(cpt["config"])
+    config[-3] = cpt["weight"]["emb_g.weight"].shape[0]  # n_spk
+    return {
+        "config": config,
+        "tgt_sr": config[-1],
+        "f0": cpt.get("f0", 1),
+        "version": cpt.get("version", "v1"),
+        "info": cpt.get("info", ""),
+    }
+
+
+def save_model(output_path: str, metadata: dict, weights: dict, half: bool = False):
+    tensors = {}
+    arrays = []
+    offset = 0
+    for name, tensor in weights.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if half and tensor.is_floating_point():
+            tensor = tensor.half()
+        array = tensor.numpy()
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        tensors[name] = {
+            "dtype": TORCH_TO_NAME[tensor.dtype],
+            "shape": list(array.shape),
+            "offset": offset,
+            "nbytes": array.nbytes,
+        }
+        arrays.append((offset, array))
+        offset += array.nbytes
+    header = json.dumps({"metadata": dict(metadata, half=half), "tensors": tensors}).encode("utf-8")
+    data_start = (len(MAGIC) + 8 + len(header) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        for tensor_offset, array in arrays:
+            file.seek(data_start + tensor_offset)
+            file.write(array.tobytes())
+        file.truncate(data_start + offset)
+    os.replace(tmp_path, output_path)
+
+
+def convert_model(model_path: str, output_path: str = None, half: bool = False) -> str:
+    """Convert a `.pth` checkpoint into the memory mapped format."""
+    if output_path is None:
+        output_path = converted_path(model_path)
+    cpt = torch.load(model_path, map_location="cpu")
+    # the posterior encoder is only used for training
+    weights = {name: tensor for name, tensor in cpt["weight"].items() if not name.startswith("enc_q.")}
+    save_model(output_path, checkpoint_metadata(cpt), weights, half=half)
+    return output_path
+
+
+def _read_raw_header(file) -> tuple:
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{file.name} is not a converted RVC model.")
+    (length,) = struct.unpack("<Q", file.read(8))
+    header = json.loads(file.read(length).decode("utf-8"))
+    data_start = (len(MAGIC) + 8 + length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    return header, data_start
+
+
+def read_header(path: str) -> dict:
+    """Read the metadata of a converted model without touching the weights."""
+    with open(path, "rb") as file:
+        header, _ = _read_raw_header(file)
+    return header["metadata"]
+
+
+def load_model(path: str) -> tuple:
+    """Return the metadata and a state dict backed by a memory map of `path`."""
+    with open(path, "rb") as file:
+        header, data_start = _read_raw_header(file)
+    # copy on write keeps the pages shared until a tensor is modified
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    weights = {}
+    for name, info in header["tensors"].items():
+        start = data_start + info["offset"]
+        array = buffer[start : start + info["nbytes"]].view(DTYPES[info["dtype"]][1])
+        weights[name] = torch.from_numpy(array.reshape(info["shape"]))
+    return header["metadata"], weights
+
+
+def sniff_model(model_path: str) -> dict:
+    """Read sample rate, version and f0 flag of any voice model as cheaply as possible."""
+    if model_path.endswith(EXTENSION):
+        return read_header(model_path)
+    if is_up_to_date(model_path):
+        return read_header(converted_path(model_path))
+    try:
+        # zip checkpoints can be mapped so the weights are never read
+        cpt = torch.load(model_path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        cpt = torch.load(model_path, map_location="cpu")
+    return checkpoint_metadata(cpt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert RVC voice models into the memory mapped format.")
+    parser.add_argument("paths", nargs="+", help="model files or directories containing models")
+    parser.add_argument("--half", action="store_true", help="store floating point weights as float16")
+    parser.add_argument("--force", action="store_true", help="convert models that are already up to date")
+    args = parser.parse_args()
+
+    model_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in files:
+                    if file.endswith(".pth"):
+                        model_paths.append(os.path.join(root, file))
+        else:
+            model_paths.append(path)
+    for model_path in model_paths:
+        if not args.force and is_up_to_date(model_path):
+            print(f"{model_path} is up to date.")
+            continue
+        print(f"converted {model_path} to {convert_model(model_path, half=args.half)}")
+
+
+if __name__ == "__main__":
+    main()
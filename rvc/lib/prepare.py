@@ -0,0 +1,46 @@
+"""Inference preparation of voice models.
+
+Training checkpoints keep weight norm on the decoder and the flow, so every
+forward pass recomputes the normalized weights of `ups`, `resblocks`,
+`in_layers`, `res_skip_layers` and `cond_layer`. Preparing a model folds the
+weight norm into plain convolution weights and drops the training only
+posterior encoder. The prepared state dict is cached in the memory mapped
+model format, in the precision of the file it was prepared from, so later
+loads skip both steps. A current `.rvc` conversion of a checkpoint is
+prepared on its own.
+"""
+import os
+import torch
+from rvc.lib import model_format
+from rvc.lib.cache import cache_path, path_key
+
+
+def fold_weight_norm(net_g: torch.nn.Module):
+    """Fold the weight norm of the decoder and the flow into plain weights."""
+    net_g.dec.remove_weight_norm()
+    net_g.flow.remove_weight_norm()
+
+
+def prepared_path(model_path: str) -> str:
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return cache_path("prepared", f"{name}-{path_key(model_path)}{model_format.EXTENSION}")
+
+
+def source_stamp(model_path: str) -> dict:
+    stat = os.stat(model_path)
+    return {"source_mtime": stat.st_mtime, "source_size": stat.st_size}
+
+
+def is_prepared(model_path: str) -> bool:
+    path = prepared_path(model_path)
+    if not os.path.exists(path):
+        return False
+    metadata = model_format.read_header(path)
+    return all(metadata.get(key) == value for key, value in source_stamp(model_path).items())
+
+
+def save_prepared(model_path: str, metadata: dict, net_g: torch.nn.Module, half: bool = False):
+    try:
+        model_format.save_model(prepared_path(model_path), dict(metadata, **source_stamp(model_path)), net_g.state_dict(), half=half)
+    except OSError as e:
+        print(f"Could not cache the prepared model {model_path}: {e}")
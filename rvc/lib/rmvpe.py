@@ -97,11 +97,12 @@ class STFT(torch.nn.Module):
         self.register_buffer('forward_basis', forward_basis.float())
         self.register_buffer('inverse_basis', inverse_basis.float())
 
-    def transform(self, input_data):
+    def transform(self, input_data, center=True):
         """Take input data (audio) to STFT domain.
 
         Arguments:
             input_data {tensor} -- Tensor of floats, with shape (num_batch, num_samples)
+            center {bool} -- Reflect-pad the input so frames are centered on their hop
 
         Returns:
             magnitude {tensor} -- Magnitude of STFT with shape (num_batch,
@@ -117,7 +118,8 @@ class STFT(torch.nn.Module):
         # similar to librosa, reflect-pad the input
         input_data = input_data.view(num_batches, 1, num_samples)
         # print(1234,input_data.shape)
-        input_data = F.pad(input_data.unsqueeze(1),(self.pad_amount, self.pad_amount, 0, 0,0,0),mode='reflect').squeeze(1)
+        if center:
+            input_data = F.pad(input_data.unsqueeze(1),(self.pad_amount, self.pad_amount, 0, 0,0,0),mode='reflect').squeeze(1)
         # print(2333,input_data.shape,self.forward_basis.shape,self.hop_length)
         # pdb.set_trace()
         forward_transform = F.conv1d(
@@ -462,6 +464,7 @@ class MelSpectrogram(torch.nn.Module):
         mel_fmin=0,
         mel_fmax=None,
         clamp=1e-5,
+        stft_backend=None,
     ):
         super().__init__()
         n_fft = win_length if n_fft is None else n_fft
@@ -483,6 +486,26 @@ class MelSpectrogram(torch.nn.Module):
         self.n_mel_channels = n_mel_channels
         self.clamp = clamp
         self.is_half = is_half
+        # "fft" uses torch.stft, "conv" the STFT module, None picks fft where supported
+        self.stft_backend = stft_backend
+        self.stft = {}
+
+    def use_fft(self, device):
+        if self.stft_backend is not None:
+            return self.stft_backend == "fft"
+        # torch.stft isn't supported by pytorch_dml
+        return device.type != "privateuseone"
+
+    def get_stft(self, n_fft, hop_length, win_length, device):
+        key = (n_fft, hop_length, win_length, str(device))
+        if key not in self.stft:
+            self.stft[key] = STFT(
+                filter_length=n_fft,
+                hop_length=hop_length,
+                win_length=win_length,
+                window='hann'
+            ).to(device)
+        return self.stft[key]
 
     def forward(self, audio, keyshift=0, speed=1, center=True):
         factor = 2 ** (keyshift / 12)
@@ -495,28 +518,23 @@ class MelSpectrogram(torch.nn.Module):
                 # "cpu"if(audio.device.type=="privateuseone") else audio.device
                 audio.device
             )
-        # fft = torch.stft(#doesn't support pytorch_dml
-        #     # audio.cpu() if(audio.device.type=="privateuseone")else audio,
-        #     audio,
-        #     n_fft=n_fft_new,
-        #     hop_length=hop_length_new,
-        #     win_length=win_length_new,
-        #     window=self.hann_window[keyshift_key],
-        #     center=center,
-        #     return_complex=True,
-        # )
-        # magnitude = torch.sqrt(fft.real.pow(2) + fft.imag.pow(2))
-        # print(1111111111)
-        # print(222222222222222,audio.device,self.is_half)
-        if hasattr(self, "stft") == False:
-        # print(n_fft_new,hop_length_new,win_length_new,audio.shape)
-            self.stft=STFT(
-                filter_length=n_fft_new,
+        if self.use_fft(audio.device):
+            # same framing as the STFT module: periodic hann, reflect padding
+            fft = torch.stft(
+                audio,
+                n_fft=n_fft_new,
                 hop_length=hop_length_new,
                 win_length=win_length_new,
-                window='hann'
-            ).to(audio.device)
-        magnitude  = self.stft.transform(audio)#phase
+                window=self.hann_window[keyshift_key],
+                center=center,
+                pad_mode="reflect",
+                return_complex=True,
+            )
+            magnitude = torch.sqrt(fft.real.pow(2) + fft.imag.pow(2))
+        else:
+            magnitude = self.get_stft(
+                n_fft_new, hop_length_new, win_length_new, audio.device
+            ).transform(audio, center=center)#phase
         # if (audio.device.type == "privateuseone"):
         #     magnitude=magnitude.to(audio.device)
         if keyshift != 0:
@@ -533,8 +551,14 @@ class MelSpectrogram(torch.nn.Module):
         return log_mel_spec
 
 
+# devices that decode the salience themselves, in float32
+DECODE_DEVICES = ("cpu", "cuda", "mps")
+# largest difference between decode and decode_torch on voiced frames
+MAX_DECODE_CENTS = 0.01
+
+
 class RMVPE:
-    def __init__(self, model_path, is_half, device=None):
+    def __init__(self, model_path, is_half, device=None, stft_backend=None):
         self.resample_kernel = {}
         self.resample_kernel = {}
         self.is_half = is_half
@@ -542,7 +566,7 @@ class RMVPE:
             device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
         self.mel_extractor = MelSpectrogram(
-            is_half, 128, 16000, 1024, 160, None, 30, 8000
+            is_half, 128, 16000, 1024, 160, None, 30, 8000, stft_backend=stft_backend
         ).to(device)
         if ("privateuseone" in str(device)):
             import onnxruntime as ort
@@ -559,6 +583,10 @@ class RMVPE:
             self.model = self.model.to(device)
         cents_mapping = 20 * np.arange(360) + 1997.3794084376191
         self.cents_mapping = np.pad(cents_mapping, (4, 4))  # 368
+        # float32 on the model's device for decode_torch, None where it decodes with numpy
+        self.cents_mapping_torch = None
+        if torch.device(device).type in DECODE_DEVICES:
+            self.cents_mapping_torch = torch.from_numpy(self.cents_mapping).float().to(device)
 
     def mel2hidden(self, mel):
         with torch.no_grad():
@@ -574,6 +602,53 @@ class RMVPE:
                 hidden = self.model(mel)
             return hidden[:, :n_frames]
 
+    def mel2hidden_windowed(self, mel, window_frames=2048, overlap_frames=128, batch_size=4):
+        """Run `mel2hidden` over overlapping windows of a long mel.
+
+        The windows are multiples of 32 frames, are stacked into batches and
+        their salience is cross-faded linearly over the overlap, so memory is
+        bounded by the window size instead of the song length.
+        """
+        n_frames = mel.shape[-1]
+        if n_frames <= window_frames:
+            return self.mel2hidden(mel)
+        assert window_frames % 32 == 0 and overlap_frames % 32 == 0
+        hop = window_frames - overlap_frames
+        n_windows = (n_frames - overlap_frames - 1) // hop + 1
+        total = (n_windows - 1) * hop + window_frames
+        with torch.no_grad():
+            mel = F.pad(mel, (0, total - n_frames), mode="reflect")
+            windows = mel.unfold(-1, window_frames, hop)[0].permute(1, 0, 2)
+            # linear ramps over the overlap that sum to one between windows
+            ramp = (torch.arange(overlap_frames, device=mel.device) + 0.5) / overlap_frames
+            fade = torch.ones(window_frames, device=mel.device)
+            fade[:overlap_frames] = ramp
+            fade[-overlap_frames:] = ramp.flip(0)
+            hidden = None
+            weight = torch.zeros(total, device=mel.device)
+            # the onnx graph is exported with a batch of one
+            if "privateuseone" in str(self.device):
+                batch_size = 1
+            for i in range(0, n_windows, batch_size):
+                batch = self.mel2hidden(windows[i : i + batch_size].contiguous())
+                if not torch.is_tensor(batch):
+                    batch = torch.from_numpy(batch).to(mel.device)
+                batch = batch.float()
+                if hidden is None:
+                    hidden = torch.zeros(total, batch.shape[-1], device=mel.device)
+                for j in range(batch.shape[0]):
+                    index = i + j
+                    start = index * hop
+                    w = fade.clone()
+                    if index == 0:
+                        w[:overlap_frames] = 1
+                    if index == n_windows - 1:
+                        w[-overlap_frames:] = 1
+                    hidden[start : start + window_frames] += batch[j] * w[:, None]
+                    weight[start : start + window_frames] += w
+            hidden = hidden / weight[:, None]
+            return hidden[None, :n_frames]
+
     def decode(self, hidden, thred=0.03):
         cents_pred = self.to_local_average_cents(hidden, thred=thred)
         f0 = 10 * (2 ** (cents_pred / 1200))
@@ -581,46 +656,63 @@ class RMVPE:
         # f0 = np.array([10 * (2 ** (cent_pred / 1200)) if cent_pred else 0 for cent_pred in cents_pred])
         return f0
 
-    def infer_from_audio(self, audio, thred=0.03):
+    def infer_from_audio(self, audio, thred=0.03, window_frames=0):
+        # window_frames > 0 bounds memory on long inputs, see mel2hidden_windowed
         # torch.cuda.synchronize()
         t0=ttime()
         mel = self.mel_extractor(torch.from_numpy(audio).float().to(self.device).unsqueeze(0), center=True)
         # print(123123123,mel.device.type)
         # torch.cuda.synchronize()
         t1=ttime()
-        hidden = self.mel2hidden(mel)
+        if window_frames:
+            hidden = self.mel2hidden_windowed(mel, window_frames=window_frames)
+        else:
+            hidden = self.mel2hidden(mel)
         # torch.cuda.synchronize()
         t2=ttime()
         # print(234234,hidden.device.type)
-        if("privateuseone" not in str(self.device)):
-            hidden = hidden.squeeze(0).cpu().numpy()
+        # decode on the model's device so only the f0 vector is copied back
+        if torch.is_tensor(hidden) and self.cents_mapping_torch is not None:
+            f0 = self.decode_torch(hidden.squeeze(0).float(), thred=thred).cpu().numpy().astype("float64")
         else:
-            hidden=hidden[0]
-        if self.is_half == True:
-            hidden = hidden.astype("float32")
-
-        f0 = self.decode(hidden, thred=thred)
+            if torch.is_tensor(hidden):
+                hidden = hidden.float().cpu().numpy()
+            f0 = self.decode(hidden[0].astype("float32"), thred=thred)
         # torch.cuda.synchronize()
         t3=ttime()
         # print("hmvpe:%s\t%s\t%s\t%s"%(t1-t0,t2-t1,t3-t2,t3-t0))
         return f0
 
+    def decode_torch(self, hidden, thred=0.03):
+        """Vectorized `decode` for a (frames, 360) salience tensor, kept on its device."""
+        cents_pred = self.to_local_average_cents_torch(hidden, thred=thred)
+        f0 = 10 * (2 ** (cents_pred / 1200))
+        f0[f0 == 10] = 0
+        return f0
+
+    def to_local_average_cents_torch(self, salience, thred=0.05):
+        center = torch.argmax(salience, dim=1)
+        maxx = torch.max(salience, dim=1).values
+        salience = F.pad(salience, (4, 4))  # 帧长,368
+        # 9 bins around the argmax, offset by the padding
+        index = center[:, None] + torch.arange(9, device=salience.device)
+        todo_salience = torch.gather(salience, 1, index)
+        todo_cents_mapping = self.cents_mapping_torch[index]
+        product_sum = torch.sum(todo_salience * todo_cents_mapping, 1)
+        weight_sum = torch.sum(todo_salience, 1)
+        devided = product_sum / weight_sum
+        devided[maxx <= thred] = 0
+        return devided
+
     def to_local_average_cents(self, salience, thred=0.05):
         # t0 = ttime()
         center = np.argmax(salience, axis=1)  # 帧长#index
         salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
         # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
-        # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        # 9 bins around the argmax, offset by the padding
+        index = center[:, None] + np.arange(9)
+        todo_salience = np.take_along_axis(salience, index, axis=1)  # 帧长，9
+        todo_cents_mapping = self.cents_mapping[index]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
@@ -652,3 +744,24 @@ if __name__ == '__main__':
     # f0 = rmvpe.infer_from_audio(audio, thred=thred)
     t1=ttime()
     print(f0.shape,t1-t0)
+    # the windowed mode should agree with the single pass away from silence
+    f0_windowed = rmvpe.infer_from_audio(audio, thred=thred, window_frames=1024)
+    t2=ttime()
+    voiced = (f0 > 0) & (f0_windowed > 0)
+    cents = 1200 * np.abs(np.log2(f0_windowed[voiced] / f0[voiced]))
+    print("windowed", f0_windowed.shape, t2-t1)
+    print("voicing agreement %.4f, max cents %.2f, mean cents %.4f" % (
+        np.mean((f0 > 0) == (f0_windowed > 0)), cents.max(), cents.mean()))
+    # the on-device decoder should match the numpy one
+    mel = rmvpe.mel_extractor(torch.from_numpy(audio).float().to(device).unsqueeze(0), center=True)
+    hidden = rmvpe.mel2hidden(mel).squeeze(0).float()
+    t3=ttime()
+    f0_numpy = rmvpe.decode(hidden.cpu().numpy(), thred=thred)
+    t4=ttime()
+    f0_torch = rmvpe.decode_torch(hidden, thred=thred).cpu().numpy()
+    t5=ttime()
+    voiced = (f0_numpy > 0) & (f0_torch > 0)
+    cents = 1200 * np.abs(np.log2(f0_torch[voiced] / f0_numpy[voiced]))
+    print("decode numpy %.4fs torch %.4fs, max cents %.6f" % (t4-t3, t5-t4, cents.max()))
+    assert np.array_equal(f0_numpy > 0, f0_torch > 0), "numpy and torch decode disagree on voicing"
+    assert cents.max() <= MAX_DECODE_CENTS, "numpy and torch decode disagree by %.6f cents" % cents.max()
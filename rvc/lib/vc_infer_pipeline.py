@@ -1,34 +1,86 @@
-import numpy as np, parselmouth, torch, sys, os
+import numpy as np, torch, sys, os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from time import time as ttime
 import torch.nn.functional as F
 import scipy.signal as signal
-import pyworld, os, traceback, faiss, librosa, torchcrepe
+import os, traceback
 from scipy import signal
-from functools import lru_cache
+from rvc.lib import f0_parallel
+from rvc.lib.autotune import geometry_for, is_out_of_memory
+from rvc.lib.cache import fingerprint
+from rvc.lib.index_cache import load_index
+
+# parselmouth, pyworld, torchcrepe, faiss and librosa are slow to import and
+# only needed by some f0 methods or when an index is used, so they are
+# imported where they are used
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
-input_audio_path2wav = {}
+# extractor parameters that are part of the f0 cache key
+F0_PARAMS = {
+    "pm": {"voicing_threshold": 0.6},
+    "harvest": {"frame_period": 10},
+    "crepe": {"model": "full", "periodicity_threshold": 0.1, "hop_factor": 1},
+    # faster crepe tiers: the tiny model, then tiny with a 4x coarser hop
+    "crepe-tiny": {"model": "tiny", "periodicity_threshold": 0.1, "hop_factor": 1},
+    "crepe-fast": {"model": "tiny", "periodicity_threshold": 0.1, "hop_factor": 4},
+    "rmvpe": {"threshold": 0.03, "window_frames": 2048},
+}
 
+# voice activity detection, in 10 ms frames
+VAD_PARAMS = {
+    "threshold_db": -50,  # relative to the loudest frame
+    "min_silence_frames": 100,
+    "margin_frames": 20,
+    "fade_frames": 1,
+}
+
+# rough peak memory of vc_batch per 16 kHz input sample of a chunk in fp32,
+# dominated by the upsampling layers of the synthesizer
+CHUNK_BYTES_PER_SAMPLE = 8 << 10
+MAX_CHUNK_BATCH = 8
+# chunks are not shrunk below this many seconds after running out of memory
+MIN_CHUNK_SECONDS = 5
+
+# batches of chunks whose features and index search run ahead of the synthesis
+RETRIEVAL_DEPTH = 1
+
+# rough peak activation memory per crepe frame, used to size the batches
+CREPE_FRAME_BYTES = {"full": 4 << 20, "tiny": 512 << 10}
+CREPE_MAX_BATCH = 2048
+
+
+def coarse_f0(f0, f0_min=50, f0_max=1100):
+    """The f0 curve in Hz quantized to the 255 mel spaced bins of the synthesizer."""
+    f0_mel_min = 1127 * np.log(1 + f0_min / 700)
+    f0_mel_max = 1127 * np.log(1 + f0_max / 700)
+    f0_mel = 1127 * np.log(1 + f0 / 700)
+    f0_mel[f0_mel > 0] = (f0_mel[f0_mel > 0] - f0_mel_min) * 254 / (
+        f0_mel_max - f0_mel_min
+    ) + 1
+    f0_mel[f0_mel <= 1] = 1
+    f0_mel[f0_mel > 255] = 255
+    return np.rint(f0_mel).astype(np.int32)
 
-@lru_cache
-def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
-    audio = input_audio_path2wav[input_audio_path]
-    f0, t = pyworld.harvest(
-        audio,
-        fs=fs,
-        f0_ceil=f0max,
-        f0_floor=f0min,
-        frame_period=frame_period,
-    )
-    f0 = pyworld.stonemask(audio, f0, t, fs)
-    return f0
+
+def uses_index(index, big_npy, index_rate):
+    return index is not None and big_npy is not None and index_rate != 0
+
+
+def set_retrieval_threads(n_threads):
+    import faiss
+
+    # openmp thread counts are per thread, this only limits the retrieval thread
+    faiss.omp_set_num_threads(n_threads)
 
 
 def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
+    import librosa
+
     # print(data1.max(),data2.max())
     rms1 = librosa.feature.rms(
         y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2
@@ -52,49 +104,69 @@ def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出
 
 class VC(object):
     def __init__(self, tgt_sr, config):
-        self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
-            config.x_pad,
-            config.x_query,
-            config.x_center,
-            config.x_max,
-            config.is_half,
-        )
+        self.is_half = config.is_half
         self.sr = 16000  # hubert输入采样率
         self.window = 160  # 每帧点数
-        self.t_pad = self.sr * self.x_pad  # 每条前后pad时间
-        self.t_pad_tgt = tgt_sr * self.x_pad
+        self.tgt_sr = tgt_sr
+        # with a context length the chunks overlap and are cross-faded instead
+        # of carrying x_pad seconds of padding that is thrown away
+        self.overlap = config.x_context is not None
+        x_pad = config.x_context if self.overlap else config.x_pad
+        self.set_geometry(x_pad, config.x_query, config.x_center, config.x_max)
+        self.device = config.device
+        self.config = config  # shared resources such as the rmvpe model
+        self.buffers = {}  # scratch tensors reused between chunks
+        self.reuse_scratch = True
+
+    def set_geometry(self, x_pad, x_query, x_center, x_max):
+        """Chunking in seconds: context padding, split point search, chunk length, unsplit maximum."""
+        self.x_pad, self.x_query, self.x_center, self.x_max = x_pad, x_query, x_center, x_max
+        # whole frames, x_pad may be a fraction of a second
+        self.t_pad = int(round(self.sr * self.x_pad / self.window)) * self.window  # 每条前后pad时间
+        self.t_pad_tgt = self.t_pad // self.window * (self.tgt_sr // 100)
         self.t_pad2 = self.t_pad * 2
+        # overlap of neighbouring chunks on each side of a seam, inside the context
+        # and at least 3 frames away from the chunk ends, which HuBERT may cut short
+        self.t_fade = 0
+        if self.overlap:
+            self.t_fade = max(0, min(self.t_pad // 2, self.t_pad - 3 * self.window)) // self.window * self.window
         self.t_query = self.sr * self.x_query  # 查询切点前后查询时间
         self.t_center = self.sr * self.x_center  # 查询切点位置
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
-        self.device = config.device
 
-    def get_f0(
-        self,
-        input_audio_path,
-        x,
-        p_len,
-        f0_up_key,
-        f0_method,
-        filter_radius,
-        inp_f0=None,
-    ):
-        global input_audio_path2wav
+    def shrink_geometry(self):
+        """Halve the chunk length after running out of memory, False if it can't shrink further."""
+        if self.x_center // 2 < MIN_CHUNK_SECONDS:
+            return False
+        geometry = geometry_for(self.x_center // 2, self.x_pad)
+        print(f"Out of memory, converting in chunks of {geometry[2]} seconds.")
+        self.set_geometry(*geometry)
+        # voice models loaded later start with the smaller chunks as well
+        config = self.config
+        config.x_query, config.x_center, config.x_max = geometry[1:]
+        return True
+
+    def crepe_batch_size(self, model):
+        """Frames per crepe batch that fit the memory budget in `Config.crepe_memory_mb`."""
+        budget = self.config.crepe_memory_mb << 20
+        if str(self.device).startswith("cuda"):
+            free, _ = torch.cuda.mem_get_info(self.device)
+            budget = min(budget, free // 2)
+        return int(max(1, min(CREPE_MAX_BATCH, budget // CREPE_FRAME_BYTES[model])))
+
+    def compute_f0(self, x, p_len, f0_method, f0_min, f0_max):
+        """Extract the raw f0 curve in Hz, see `F0_PARAMS` for the fixed parameters."""
+        params = F0_PARAMS[f0_method]
         time_step = self.window / self.sr * 1000
-        f0_min = 50
-        f0_max = 1100
-        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
-        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
         if f0_method == "pm":
-            f0 = (
-                parselmouth.Sound(x, self.sr)
-                .to_pitch_ac(
-                    time_step=time_step / 1000,
-                    voicing_threshold=0.6,
-                    pitch_floor=f0_min,
-                    pitch_ceiling=f0_max,
-                )
-                .selected_array["frequency"]
+            f0 = f0_parallel.pm(
+                x,
+                self.sr,
+                time_step / 1000,
+                params["voicing_threshold"],
+                f0_min,
+                f0_max,
+                n_workers=self.config.n_cpu,
             )
             pad_size = (p_len - len(f0) + 1) // 2
             if pad_size > 0 or p_len - len(f0) - pad_size > 0:
@@ -102,20 +174,26 @@ class VC(object):
                     f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
                 )
         elif f0_method == "harvest":
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
-            f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
-            if filter_radius > 2:
-                f0 = signal.medfilt(f0, 3)
-        elif f0_method == "crepe":
-            model = "full"
-            # Pick a batch size that doesn't cause memory errors on your gpu
-            batch_size = 512
-            # Compute pitch using first gpu
-            audio = torch.tensor(np.copy(x))[None].float()
+            f0 = f0_parallel.harvest(
+                x,
+                self.sr,
+                f0_min,
+                f0_max,
+                params["frame_period"],
+                n_workers=self.config.n_cpu,
+            )
+        elif f0_method.startswith("crepe"):
+            import torchcrepe
+
+            model = params["model"]
+            hop_length = self.window * params["hop_factor"]
+            # torchcrepe frames the audio lazily and runs it in batches of this size
+            batch_size = self.crepe_batch_size(model)
+            audio = torch.from_numpy(x)[None].float()
             f0, pd = torchcrepe.predict(
                 audio,
                 self.sr,
-                self.window,
+                hop_length,
                 f0_min,
                 f0_max,
                 model,
@@ -125,18 +203,50 @@ class VC(object):
             )
             pd = torchcrepe.filter.median(pd, 3)
             f0 = torchcrepe.filter.mean(f0, 3)
-            f0[pd < 0.1] = 0
+            f0[pd < params["periodicity_threshold"]] = 0
             f0 = f0[0].cpu().numpy()
+            if params["hop_factor"] > 1:
+                # back onto the regular frame grid, keeping the voicing decisions
+                n_frames = x.shape[0] // self.window + 1
+                t = np.arange(n_frames) / params["hop_factor"]
+                t_coarse = np.arange(len(f0))
+                voiced = np.interp(t, t_coarse, (f0 > 0).astype(np.float32)) >= 0.5
+                f0 = np.interp(t, t_coarse[f0 > 0], f0[f0 > 0]) if voiced.any() else np.zeros(n_frames)
+                f0[~voiced] = 0
         elif f0_method == "rmvpe":
-            if hasattr(self, "model_rmvpe") == False:
-                from rvc.lib.rmvpe import RMVPE
+            if self.config.model_rmvpe is None:
+                self.config.load_rmvpe()
+            f0 = self.config.model_rmvpe.infer_from_audio(
+                x, thred=params["threshold"], window_frames=params["window_frames"]
+            )
+        return f0
 
-                print("loading rmvpe model")
-                self.model_rmvpe = RMVPE(
-                    "rvc/rmvpe.pt", is_half=self.is_half, device=self.device
-                )
-            f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
-        f0 *= pow(2, f0_up_key / 12)
+    def get_f0(
+        self,
+        x,
+        p_len,
+        f0_up_key,
+        f0_method,
+        filter_radius,
+        inp_f0=None,
+        audio_fingerprint=None,
+    ):
+        f0_min = 50
+        f0_max = 1100
+        f0_cache = self.config.f0_cache
+        params = dict(F0_PARAMS[f0_method], sr=self.sr, window=self.window, f0_min=f0_min, f0_max=f0_max, p_len=p_len)
+        if f0_method.startswith("crepe") or f0_method == "rmvpe":
+            params["is_half"] = self.is_half
+        if audio_fingerprint is None:
+            audio_fingerprint = fingerprint(x)
+        key = f0_cache.key(audio_fingerprint, f0_method, params)
+        f0 = f0_cache.get(key)
+        if f0 is None:
+            f0 = self.compute_f0(x, p_len, f0_method, f0_min, f0_max)
+            f0_cache.put(key, f0)
+        if f0_method == "harvest" and filter_radius > 2:
+            f0 = signal.medfilt(f0, 3)
+        f0 = f0 * pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         tf0 = self.sr // self.window  # 每秒f0点数
         if inp_f0 is not None:
@@ -146,21 +256,138 @@ class VC(object):
             replace_f0 = np.interp(
                 list(range(delta_t)), inp_f0[:, 0] * 100, inp_f0[:, 1]
             )
-            shape = f0[self.x_pad * tf0 : self.x_pad * tf0 + len(replace_f0)].shape[0]
-            f0[self.x_pad * tf0 : self.x_pad * tf0 + len(replace_f0)] = replace_f0[
+            pad_frames = self.t_pad // self.window
+            shape = f0[pad_frames : pad_frames + len(replace_f0)].shape[0]
+            f0[pad_frames : pad_frames + len(replace_f0)] = replace_f0[
                 :shape
             ]
         # with open("test_opt.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         f0bak = f0.copy()
-        f0_mel = 1127 * np.log(1 + f0 / 700)
-        f0_mel[f0_mel > 0] = (f0_mel[f0_mel > 0] - f0_mel_min) * 254 / (
-            f0_mel_max - f0_mel_min
-        ) + 1
-        f0_mel[f0_mel <= 1] = 1
-        f0_mel[f0_mel > 255] = 255
-        f0_coarse = np.rint(f0_mel).astype(np.int32)
+        f0_coarse = coarse_f0(f0, f0_min, f0_max)
         return f0_coarse, f0bak  # 1-0
 
+    def scratch(self, name, shape, dtype):
+        """Reusable buffer of at least `shape`, only grown when a larger one is needed.
+
+        The contents are whatever the previous user left, buffers are kept
+        until `release_scratch` at the end of a conversion.
+        """
+        numel = int(np.prod(shape))
+        buffer = self.buffers.get(name) if self.reuse_scratch else None
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, device=self.device)
+            self.buffers[name] = buffer
+        return buffer[:numel].view(*shape)
+
+    def release_scratch(self):
+        self.buffers = {}
+
+    def hubert_frames(self, model, n_samples):
+        """Number of HuBERT frames for `n_samples` of audio, without running it."""
+        return int(model.feature_extractor.output_lengths(torch.tensor(n_samples)))
+
+    def chunk_output_length(self, model, n_samples):
+        """Length of the trimmed output of a chunk of `n_samples`, see `vc_batch`."""
+        p_len = min(n_samples // self.window, 2 * self.hubert_frames(model, n_samples))
+        return p_len * (self.tgt_sr // 100) - 2 * self.t_pad_tgt
+
+    def padded_places(self, model, chunks):
+        """Output slices of chunks that are padded by `t_pad` and simply concatenated."""
+        places = []
+        offset = 0
+        for chunk in chunks:
+            length = max(0, self.chunk_output_length(model, chunk[0].shape[0]))
+            places.append((offset, offset + length, self.t_pad_tgt, None, None))
+            offset += length
+        return places, offset
+
+    def overlap_places(self, model, chunks, n_audio):
+        """Output slices of chunks that overlap by `t_fade` around every seam.
+
+        The output follows the input frame by frame. Each chunk keeps
+        `t_fade` of its context on both sides of its seams, the overlapping
+        parts of neighbours are cross-faded with complementary linear ramps.
+        """
+        upp = self.tgt_sr // 100
+        pad_frames = self.t_pad // self.window
+        fade_frames = self.t_fade // self.window
+        n_frames = n_audio // self.window
+        n_ramp = (2 * fade_frames + 1) * upp
+        ramp = (torch.arange(n_ramp, device=self.device, dtype=torch.float32) + 0.5) / n_ramp
+        places = []
+        for j, (audio0, _, _, (_, start, end)) in enumerate(chunks):
+            last = j == len(chunks) - 1
+            # frames of the audio, the chunk starts pad_frames before its first one
+            first_frame = start // self.window - pad_frames
+            keep_start = 0 if j == 0 else start // self.window - fade_frames
+            if last:
+                keep_end = n_frames
+            else:
+                # the chunk input ends with t_pad2 of context after its last frame
+                keep_end = (end - self.t_pad2) // self.window + fade_frames
+            intended = (keep_end - keep_start) * upp
+            keep_end = min(keep_end, n_frames)
+            skip = (keep_start - first_frame) * upp
+            available = min(audio0.shape[0] // self.window, 2 * self.hubert_frames(model, audio0.shape[0])) * upp
+            length = max(0, min((keep_end - keep_start) * upp, available - skip))
+            # a seam close to the end of the audio cuts the ramps short
+            ramp_in = None if j == 0 else ramp[: min(n_ramp, length)]
+            ramp_out = None if last else ramp.flip(0)[: max(0, n_ramp - (intended - length))]
+            start_sample = keep_start * upp
+            places.append((start_sample, start_sample + length, skip, ramp_in, ramp_out))
+        return places, n_frames * upp
+
+    def place(self, destination, source, ramp_in=None, ramp_out=None):
+        """Write a chunk's output, fading its ends into what neighbours already added."""
+        if ramp_in is None and ramp_out is None and not self.overlap:
+            destination.copy_(source)
+            return
+        source = source.float()
+        n = destination.shape[0]
+        head = 0 if ramp_in is None else ramp_in.shape[0]
+        tail = 0 if ramp_out is None else ramp_out.shape[0]
+        if head:
+            destination[:head].addcmul_(source[:head], ramp_in)
+        destination[head : n - tail].add_(source[head : n - tail])
+        if tail:
+            destination[n - tail :].addcmul_(source[n - tail :], ramp_out)
+
+    def extract_features(self, model, audios, version):
+        """HuBERT features of each array in `audios`, run as one padded batch."""
+        lengths = [audio0.shape[0] for audio0 in audios]
+        dtype = torch.float16 if self.is_half else torch.float32
+        feats = self.scratch("source", (len(audios), max(lengths)), dtype)
+        for i, audio0 in enumerate(audios):
+            audio0 = torch.from_numpy(audio0)
+            if audio0.dim() == 2:  # double channels
+                audio0 = audio0.mean(-1)
+            assert audio0.dim() == 1, audio0.dim()
+            feats[i, : lengths[i]].copy_(audio0)
+            feats[i, lengths[i] :].zero_()
+        inputs = {
+            "source": feats,
+            "padding_mask": None,
+            "output_layer": 9 if version == "v1" else 12,
+        }
+        # whether there is padding is known here, so HuBERT doesn't read the mask back
+        if min(lengths) < max(lengths):
+            # filled on the device, a copy of the list would wait for the host
+            lengths_device = self.scratch("lengths", (len(audios),), torch.long)
+            for i, length in enumerate(lengths):
+                lengths_device[i].fill_(length)
+            positions = self.scratch("positions", (max(lengths),), torch.long)
+            torch.arange(max(lengths), out=positions)
+            padding_mask = self.scratch("padding_mask", feats.shape, torch.bool)
+            torch.ge(positions[None], lengths_device[:, None], out=padding_mask)
+            inputs["padding_mask"] = padding_mask
+            inputs["lengths"] = lengths_device
+        with torch.no_grad():
+            logits = model.extract_features(**inputs)
+            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        # frame counts from the convolution lengths, reading the mask back would sync
+        n_frames = [self.hubert_frames(model, length) for length in lengths]
+        return [feats[i : i + 1, : n_frames[i]] for i in range(len(audios))]
+
     def vc(
         self,
         model,
@@ -175,95 +402,317 @@ class VC(object):
         index_rate,
         version,
         protect,
+        cache_key=None,
     ):  # ,file_index,file_big_npy
-        feats = torch.from_numpy(audio0)
+        return self.vc_batch(
+            model, net_g, sid, [(audio0, pitch, pitchf, cache_key)], times,
+            index, big_npy, index_rate, version, protect,
+        )[0]
+
+    def batch_features(self, model, chunks, version):
+        """HuBERT features of `chunks`, from the feature cache where possible."""
+        feature_cache = self.config.feature_cache
+        feats_list = [None] * len(chunks)
+        cache_keys = [None] * len(chunks)
+        for i, (_, _, _, cache_key) in enumerate(chunks):
+            if cache_key is not None and feature_cache is not None:
+                cache_keys[i] = feature_cache.key(*cache_key, version)
+                feats_list[i] = feature_cache.get(
+                    cache_keys[i], self.device, torch.float16 if self.is_half else torch.float32
+                )
+        missing = [i for i, feats in enumerate(feats_list) if feats is None]
+        if missing:
+            extracted = self.extract_features(model, [chunks[i][0] for i in missing], version)
+            for i, feats in zip(missing, extracted):
+                feats_list[i] = feats
+                if cache_keys[i] is not None:
+                    feature_cache.put(cache_keys[i], feats)
+        return feats_list
+
+    def search_input(self, feats_list):
+        """The frames of all chunks stacked for one index search, waits for the device."""
+        npy = np.concatenate([feats[0].cpu().numpy() for feats in feats_list])
         if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
-        if feats.dim() == 2:  # double channels
-            feats = feats.mean(-1)
-        assert feats.dim() == 1, feats.dim()
-        feats = feats.view(1, -1)
-        padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
+            npy = npy.astype("float32")
+        return npy
 
-        inputs = {
-            "source": feats.to(self.device),
-            "padding_mask": padding_mask,
-            "output_layer": 9 if version == "v1" else 12,
-        }
-        t0 = ttime()
-        with torch.no_grad():
-            logits = model.extract_features(**inputs)
-            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
-        if protect < 0.5 and pitch != None and pitchf != None:
-            feats0 = feats.clone()
-        if (
-            isinstance(index, type(None)) == False
-            and isinstance(big_npy, type(None)) == False
-            and index_rate != 0
-        ):
-            npy = feats[0].cpu().numpy()
-            if self.is_half:
-                npy = npy.astype("float32")
-
-            # _, I = index.search(npy, 1)
-            # npy = big_npy[I.squeeze()]
-
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
-
-            if self.is_half:
-                npy = npy.astype("float16")
-            feats = (
-                torch.from_numpy(npy).unsqueeze(0).to(self.device) * index_rate
-                + (1 - index_rate) * feats
-            )
+    def retrieve(self, npy, index, big_npy):
+        """Weighted mean of the 8 nearest index entries of every frame, only touches numpy and faiss."""
+        # _, I = index.search(npy, 1)
+        # npy = big_npy[I.squeeze()]
 
-        feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
-        if protect < 0.5 and pitch != None and pitchf != None:
-            feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(
-                0, 2, 1
-            )
-        t1 = ttime()
-        p_len = audio0.shape[0] // self.window
-        if feats.shape[1] < p_len:
-            p_len = feats.shape[1]
-            if pitch != None and pitchf != None:
-                pitch = pitch[:, :p_len]
-                pitchf = pitchf[:, :p_len]
-
-        if protect < 0.5 and pitch != None and pitchf != None:
-            pitchff = pitchf.clone()
-            pitchff[pitchf > 0] = 1
-            pitchff[pitchf < 1] = protect
-            pitchff = pitchff.unsqueeze(-1)
-            feats = feats * pitchff + feats0 * (1 - pitchff)
-            feats = feats.to(feats0.dtype)
-        p_len = torch.tensor([p_len], device=self.device).long()
+        score, ix = index.search(npy, k=8)
+        weight = np.square(1 / score)
+        weight /= weight.sum(axis=1, keepdims=True)
+        npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+
+        if self.is_half:
+            npy = npy.astype("float16")
+        return npy
+
+    def blend(self, feats_list, npy, index_rate):
+        """Mix the retrieved frames `npy` into the features of each chunk."""
+        offsets = np.cumsum([0] + [feats.shape[1] for feats in feats_list])
+        return [
+            torch.from_numpy(npy[offsets[i] : offsets[i + 1]]).unsqueeze(0).to(self.device) * index_rate
+            + (1 - index_rate) * feats
+            for i, feats in enumerate(feats_list)
+        ]
+
+    def synthesize(self, net_g, sid, chunks, feats_list, feats0_list, protect, out=None, placed=None):
+        """Run `net_g.infer` on the padded batch of `chunks`, see `vc_batch`.
+
+        The position of every chunk whose output is written to `out` is
+        appended to `placed`.
+        """
+        has_f0 = chunks[0][1] is not None and chunks[0][2] is not None
+        # padded batch, the features are repeated to the 2x frame rate in place,
+        # with one spare frame for odd lengths
+        p_lens = []
+        for i, (audio0, _, _, _) in enumerate(chunks):
+            p_lens.append(min(audio0.shape[0] // self.window, 2 * feats_list[i].shape[1]))
+        max_len = max(p_lens)
+        n_channels = feats_list[0].shape[-1]
+        feats = self.scratch("feats", (len(chunks), max_len + 1, n_channels), feats_list[0].dtype)
+        if has_f0:
+            pitch = self.scratch("pitch", (len(chunks), max_len + 1), torch.long)
+            pitchf = self.scratch("pitchf", (len(chunks), max_len + 1), chunks[0][2].dtype)
+        for i, (_, chunk_pitch, chunk_pitchf, _) in enumerate(chunks):
+            p_len = p_lens[i]
+            n_frames = (p_len + 1) // 2
+            doubled = feats[i, : 2 * n_frames].view(n_frames, 2, n_channels)
+            doubled.copy_(feats_list[i][0, :n_frames, None].expand(n_frames, 2, n_channels))
+            if has_f0:
+                pitch[i, :p_len] = chunk_pitch[0, :p_len]
+                pitch[i, p_len:].zero_()
+                pitchf[i, :p_len] = chunk_pitchf[0, :p_len]
+                pitchf[i, p_len:].zero_()
+                if protect < 0.5:
+                    # unvoiced frames keep part of the features from before the index search
+                    voiced = pitchf[i, : 2 * n_frames] > 0
+                    pitchff = torch.full(voiced.shape, protect, dtype=feats.dtype, device=self.device)
+                    pitchff.masked_fill_(voiced, 1)
+                    pitchff = pitchff.view(n_frames, 2, 1)
+                    doubled.mul_(pitchff)
+                    doubled.addcmul_(feats0_list[i][0, :n_frames, None], 1 - pitchff)
+            feats[i, p_len:].zero_()
+        feats = feats[:, :max_len]
+        if has_f0:
+            pitch = pitch[:, :max_len]
+            pitchf = pitchf[:, :max_len]
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sids = sid.repeat(len(chunks))
         with torch.no_grad():
-            if pitch != None and pitchf != None:
-                audio1 = (
-                    (net_g.infer(feats, p_len, pitch, pitchf, sid)[0][0, 0])
-                    .data.cpu()
-                    .float()
-                    .numpy()
-                )
+            if has_f0:
+                audio1 = net_g.infer(feats, p_len, pitch, pitchf, sids)[0][:, 0]
             else:
-                audio1 = (
-                    (net_g.infer(feats, p_len, sid)[0][0, 0]).data.cpu().float().numpy()
-                )
-        del feats, p_len, padding_mask
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+                audio1 = net_g.infer(feats, p_len, sids)[0][:, 0]
+            # samples per frame of the synthesizer
+            upp = audio1.shape[-1] // max_len
+            if out is None:
+                audio1 = [
+                    audio1[i, : p_lens[i] * upp].data.cpu().float().numpy()
+                    for i in range(len(chunks))
+                ]
+            else:
+                for i, (destination, skip, ramp_in, ramp_out) in enumerate(out):
+                    self.place(destination, audio1[i, skip : skip + destination.shape[0]], ramp_in, ramp_out)
+                    if placed is not None:
+                        placed.append(i)
+                audio1 = None
+        del feats, p_len
+        return audio1
+
+    def vc_batch(
+        self,
+        model,
+        net_g,
+        sid,
+        chunks,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        out=None,
+    ):
+        """Convert several chunks at once.
+
+        `chunks` holds (audio0, pitch, pitchf, cache_key) tuples, pitch and
+        pitchf are None for models without f0. HuBERT and `net_g.infer` each
+        run once on the zero padded batch with the real lengths. Without
+        `out` the converted audio of every chunk is returned as numpy arrays,
+        otherwise `out` holds a (destination, skip, ramp_in, ramp_out) tuple
+        per chunk, see `place`, and the output is written there on the
+        device without waiting for it.
+        """
+        t0 = ttime()
+        feats0_list = self.batch_features(model, chunks, version)
+        feats_list = feats0_list
+        if uses_index(index, big_npy, index_rate):
+            # one search for the frames of all chunks
+            npy = self.retrieve(self.search_input(feats0_list), index, big_npy)
+            feats_list = self.blend(feats0_list, npy, index_rate)
+        t1 = ttime()
+        audio1 = self.synthesize(net_g, sid, chunks, feats_list, feats0_list, protect, out)
         t2 = ttime()
         times[0] += t1 - t0
         times[2] += t2 - t1
         return audio1
 
-    def pipeline(
+    def prepare_batch(self, model, chunks, version, index, big_npy, retrieval):
+        """Features of a batch, with the index search handed to the `retrieval` thread."""
+        feats_list = self.batch_features(model, chunks, version)
+        if retrieval is None:
+            return feats_list, None
+        return feats_list, retrieval.submit(self.retrieve, self.search_input(feats_list), index, big_npy)
+
+    def retrieval_pool(self):
+        """The worker thread for `prepare_batch`.
+
+        On cpu faiss gets `Config.retrieval_threads` of the cores and torch
+        the rest for the time of the conversion, instead of both spreading
+        over all of them. Returns the pool and the previous torch thread count.
+        """
+        n_threads = torch.get_num_threads()
+        if not str(self.device).startswith("cpu"):
+            return ThreadPoolExecutor(1), n_threads
+        n_retrieval = self.config.retrieval_threads or max(1, self.config.n_cpu // 4)
+        torch.set_num_threads(max(1, self.config.n_cpu - n_retrieval))
+        return ThreadPoolExecutor(1, initializer=set_retrieval_threads, initargs=(n_retrieval,)), n_threads
+
+    def run_batches(self, model, net_g, sid, chunks, order, out, times, index, big_npy, index_rate, version, protect):
+        """Convert `chunks` in batches of the given `order` into their `out` places.
+
+        With an index, the features and search of the following batches run
+        ahead of the synthesis. faiss releases the GIL, so the search of the
+        next batch runs on a worker thread while the device, or torch on the
+        other cores, synthesizes the current one. At most `RETRIEVAL_DEPTH`
+        batches are prepared ahead, which keeps the memory flat.
+        """
+        batch_size = self.chunk_batch_size(max(chunk[0].shape[0] for chunk in chunks))
+        retrieval = None
+        if uses_index(index, big_npy, index_rate) and self.config.pipeline_retrieval and len(order) > 1:
+            retrieval, n_threads = self.retrieval_pool()
+        order = list(order)
+        queue = deque()
+        queued = 0  # chunks of `order` that are prepared
+        done = 0
+        try:
+            while done < len(order):
+                placed = []
+                try:
+                    t0 = ttime()
+                    while queued < len(order) and len(queue) <= (RETRIEVAL_DEPTH if retrieval is not None else 0):
+                        batch = order[queued : queued + batch_size]
+                        queue.append((batch, self.prepare_batch(model, [chunks[j] for j in batch], version, index, big_npy, retrieval)))
+                        queued += len(batch)
+                    batch, (feats0_list, search) = queue.popleft()
+                    feats_list = feats0_list
+                    if search is not None:
+                        feats_list = self.blend(feats0_list, search.result(), index_rate)
+                    elif uses_index(index, big_npy, index_rate):
+                        npy = self.retrieve(self.search_input(feats0_list), index, big_npy)
+                        feats_list = self.blend(feats0_list, npy, index_rate)
+                    t1 = ttime()
+                    self.synthesize(net_g, sid, [chunks[j] for j in batch], feats_list, feats0_list, protect, [out[j] for j in batch], placed)
+                    times[0] += t1 - t0
+                    times[2] += ttime() - t1
+                except RuntimeError as e:
+                    # retry with smaller batches, single chunks are left to convert_span_shrinking
+                    if not is_out_of_memory(e) or batch_size == 1:
+                        raise
+                    # overlapping chunks are added to the output, so the ones
+                    # that were already written must not be converted again
+                    written = {batch[i] for i in placed}
+                    order = order[:done] + [j for j in order[done:] if j not in written]
+                    queue.clear()
+                    queued = done
+                    torch.cuda.empty_cache()
+                    batch_size = max(1, batch_size // 2)
+                    continue
+                done += len(batch)
+        finally:
+            if retrieval is not None:
+                retrieval.shutdown(wait=True)
+                torch.set_num_threads(n_threads)
+
+    def split_points(self, audio):
+        """Chunk boundaries for audio longer than `t_max`.
+
+        Around every multiple of `t_center` the sample within `t_query` where
+        the 10 ms moving sum of the audio is closest to zero is picked. Only
+        the query windows are gathered. Their moving sums reduce a strided
+        view of the shifted windows along its middle axis, which numpy adds
+        up one shifted window after the other like the former per-sample
+        loop, so the sums and the picked samples are identical to it.
+        """
+        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
+        if audio_pad.shape[0] <= self.t_max:
+            return []
+        centers = np.arange(self.t_center, audio.shape[0], self.t_center)
+        if centers.shape[0] == 0:
+            return []
+        starts = centers - self.t_query
+        width = 2 * self.t_query
+        # samples of audio_pad covered by the moving sums of each query window
+        index = starts[:, None] + np.arange(width + self.window)
+        rows = audio_pad[np.minimum(index, audio_pad.shape[0] - 1)]
+        # shifted[:, i, j] is rows[:, i + j], a view without copies
+        shifted = np.lib.stride_tricks.sliding_window_view(rows, width, axis=1)[:, : self.window]
+        envelope = np.abs(np.add.reduce(shifted, axis=1))
+        # query windows are cut off at the end of the audio
+        envelope[index[:, :width] >= audio.shape[0]] = np.inf
+        return (starts + np.argmin(envelope, axis=1)).tolist()
+
+    def chunk_batch_size(self, chunk_samples):
+        """Chunks per `vc_batch` call, `Config.chunk_batch_size` or estimated from free memory."""
+        if self.config.chunk_batch_size > 0:
+            return self.config.chunk_batch_size
+        if not str(self.device).startswith("cuda"):
+            # cpu convolutions are already spread over all cores by a single chunk
+            return 1
+        free, _ = torch.cuda.mem_get_info(self.device)
+        per_chunk = chunk_samples * CHUNK_BYTES_PER_SAMPLE // (2 if self.is_half else 1)
+        return int(max(1, min(MAX_CHUNK_BATCH, free // 2 // per_chunk)))
+
+    def voiced_spans(self, audio):
+        """Sample ranges of `audio` that need converting, see `VAD_PARAMS`.
+
+        Frames more than `threshold_db` below the loudest frame are silent.
+        Silent runs of at least `min_silence_frames` are skipped, apart from
+        `margin_frames` on each side that stay with the neighbouring voice.
+        Returns None when nothing can be skipped.
+        """
+        n_frames = audio.shape[0] // self.window
+        if n_frames == 0:
+            return None
+        frames = audio[: n_frames * self.window].reshape(n_frames, self.window)
+        db = 10 * np.log10(np.mean(frames.astype(np.float64) ** 2, axis=1) + 1e-12)
+        silent = db < db.max() + VAD_PARAMS["threshold_db"]
+        # starts and ends of the silent runs
+        edges = np.diff(np.concatenate([[0], silent.astype(np.int8), [0]]))
+        starts, ends = np.where(edges == 1)[0], np.where(edges == -1)[0]
+        margin = VAD_PARAMS["margin_frames"]
+        skipped = []
+        for start, end in zip(starts, ends):
+            if end - start < VAD_PARAMS["min_silence_frames"]:
+                continue
+            skipped.append((start + margin if start > 0 else 0, end - margin if end < n_frames else n_frames))
+        if not skipped:
+            return None
+        spans = []
+        position = 0
+        for start, end in skipped:
+            if start > position:
+                spans.append((position * self.window, start * self.window))
+            position = end
+        if position < n_frames:
+            spans.append((position * self.window, audio.shape[0]))
+        return spans
+
+    def convert_span(
         self,
         model,
         net_g,
@@ -273,78 +722,34 @@ class VC(object):
         times,
         f0_up_key,
         f0_method,
-        file_index,
-        # file_big_npy,
+        index,
+        big_npy,
         index_rate,
         if_f0,
         filter_radius,
-        tgt_sr,
-        resample_sr,
-        rms_mix_rate,
         version,
         protect,
-        f0_file=None,
+        inp_f0=None,
     ):
-        if (
-            file_index != ""
-            # and file_big_npy != ""
-            # and os.path.exists(file_big_npy) == True
-            and os.path.exists(file_index) == True
-            and index_rate != 0
-        ):
-            try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
-            except:
-                traceback.print_exc()
-                index = big_npy = None
-        else:
-            index = big_npy = None
-        audio = signal.filtfilt(bh, ah, audio)
-        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
-        opt_ts = []
-        if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += audio_pad[i : i - self.window]
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                opt_ts.append(
-                    t
-                    - self.t_query
-                    + np.where(
-                        np.abs(audio_sum[t - self.t_query : t + self.t_query])
-                        == np.abs(audio_sum[t - self.t_query : t + self.t_query]).min()
-                    )[0][0]
-                )
+        """Convert a span of filtered 16 kHz audio in chunks cut at quiet points."""
+        opt_ts = self.split_points(audio)
         s = 0
         audio_opt = []
         t = None
         t1 = ttime()
         audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
+        audio_fingerprint = fingerprint(audio_pad)
         p_len = audio_pad.shape[0] // self.window
-        inp_f0 = None
-        if hasattr(f0_file, "name") == True:
-            try:
-                with open(f0_file.name, "r") as f:
-                    lines = f.read().strip("\n").split("\n")
-                inp_f0 = []
-                for line in lines:
-                    inp_f0.append([float(i) for i in line.split(",")])
-                inp_f0 = np.array(inp_f0, dtype="float32")
-            except:
-                traceback.print_exc()
-        sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
         pitch, pitchf = None, None
         if if_f0 == 1:
             pitch, pitchf = self.get_f0(
-                input_audio_path,
                 audio_pad,
                 p_len,
                 f0_up_key,
                 f0_method,
                 filter_radius,
                 inp_f0,
+                audio_fingerprint,
             )
             pitch = pitch[:p_len]
             pitchf = pitchf[:p_len]
@@ -354,81 +759,124 @@ class VC(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
+        chunks = []
         for t in opt_ts:
             t = t // self.window * self.window
-            if if_f0 == 1:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
+            chunks.append(
+                (
+                    audio_pad[s : t + self.t_pad2 + self.window],
+                    pitch[:, s // self.window : (t + self.t_pad2) // self.window] if if_f0 == 1 else None,
+                    pitchf[:, s // self.window : (t + self.t_pad2) // self.window] if if_f0 == 1 else None,
+                    (audio_fingerprint, s, t + self.t_pad2 + self.window),
                 )
+            )
             s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
+        chunks.append(
+            (
+                audio_pad[t:],
+                (pitch[:, t // self.window :] if t is not None else pitch) if if_f0 == 1 else None,
+                (pitchf[:, t // self.window :] if t is not None else pitchf) if if_f0 == 1 else None,
+                (audio_fingerprint, t or 0, audio_pad.shape[0]),
             )
+        )
+        # chunks of similar length share a batch to keep the padding small
+        order = sorted(range(len(chunks)), key=lambda i: chunks[i][0].shape[0])
+        # every chunk is written straight to its place in the output
+        if self.overlap:
+            places, n_samples = self.overlap_places(model, chunks, audio.shape[0])
         else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
+            places, n_samples = self.padded_places(model, chunks)
+        audio_opt = torch.zeros(n_samples, dtype=torch.float32, device=self.device)
+        out = [(audio_opt[start:end], skip, ramp_in, ramp_out) for start, end, skip, ramp_in, ramp_out in places]
+        self.run_batches(model, net_g, sid, chunks, order, out, times, index, big_npy, index_rate, version, protect)
+        del pitch, pitchf
+        # the only copy back to the host and wait for the device
+        return audio_opt.cpu().numpy()
+
+    def convert_span_shrinking(self, *args):
+        """`convert_span` that retries with shorter chunks when the device runs out of memory."""
+        while True:
+            try:
+                return self.convert_span(*args)
+            except RuntimeError as e:
+                if not is_out_of_memory(e):
+                    raise
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                if not self.shrink_geometry():
+                    raise
+
+    def pipeline(
+        self,
+        model,
+        net_g,
+        sid,
+        audio,
+        input_audio_path,
+        times,
+        f0_up_key,
+        f0_method,
+        file_index,
+        # file_big_npy,
+        index_rate,
+        if_f0,
+        filter_radius,
+        tgt_sr,
+        resample_sr,
+        rms_mix_rate,
+        version,
+        protect,
+        f0_file=None,
+        index=None,
+        big_npy=None,
+        vad=False,
+    ):
+        if index_rate == 0:
+            index = big_npy = None
+        elif index is None:
+            index, big_npy = load_index(file_index, self.is_half)
+        audio = signal.filtfilt(bh, ah, audio)
+        inp_f0 = None
+        if hasattr(f0_file, "name") == True:
+            try:
+                with open(f0_file.name, "r") as f:
+                    lines = f.read().strip("\n").split("\n")
+                inp_f0 = []
+                for line in lines:
+                    inp_f0.append([float(i) for i in line.split(",")])
+                inp_f0 = np.array(inp_f0, dtype="float32")
+            except:
+                traceback.print_exc()
+        sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
+        # an f0 file is timed against the whole input, so it isn't split
+        spans = self.voiced_spans(audio) if vad and inp_f0 is None else None
+        if spans is None:
+            audio_opt = self.convert_span_shrinking(
+                model, net_g, sid, audio, input_audio_path, times, f0_up_key, f0_method,
+                index, big_npy, index_rate, if_f0, filter_radius, version, protect, inp_f0,
             )
-        audio_opt = np.concatenate(audio_opt)
+        else:
+            # silent spans are left silent, voiced spans are converted on their own
+            tgt_window = tgt_sr // 100
+            audio_opt = np.zeros(audio.shape[0] // self.window * tgt_window, dtype=np.float32)
+            fade = np.linspace(0, 1, VAD_PARAMS["fade_frames"] * tgt_window, dtype=np.float32)
+            for start, end in spans:
+                span_opt = self.convert_span_shrinking(
+                    model, net_g, sid, audio[start:end], input_audio_path, times, f0_up_key, f0_method,
+                    index, big_npy, index_rate, if_f0, filter_radius, version, protect, None,
+                )
+                offset = start // self.window * tgt_window
+                span_opt = span_opt[: min(end // self.window * tgt_window, audio_opt.shape[0]) - offset]
+                if start > 0 and span_opt.shape[0] > fade.shape[0]:
+                    span_opt[: fade.shape[0]] *= fade
+                if end < audio.shape[0] and span_opt.shape[0] > fade.shape[0]:
+                    span_opt[-fade.shape[0] :] *= fade[::-1]
+                audio_opt[offset : offset + span_opt.shape[0]] = span_opt
         if rms_mix_rate != 1:
             audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
         if resample_sr >= 16000 and tgt_sr != resample_sr:
+            import librosa
+
             audio_opt = librosa.resample(
                 audio_opt, orig_sr=tgt_sr, target_sr=resample_sr
             )
@@ -437,7 +885,6 @@ class VC(object):
         if audio_max > 1:
             max_int16 /= audio_max
         audio_opt = (audio_opt * max_int16).astype(np.int16)
-        del pitch, pitchf, sid
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        del sid
+        self.release_scratch()
         return audio_opt
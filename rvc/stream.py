@@ -0,0 +1,257 @@
+"""Low latency conversion of a live audio stream.
+
+`StreamConverter` converts 16 kHz mono audio in blocks of `block_frames`
+10 ms frames as it arrives. It keeps a rolling window of the input, made up
+of `context_frames` of past audio in front of the newest frames, together
+with the f0 and HuBERT features of every frame in the window. Each block
+extracts f0 and features only for its new frames, with a little context of
+their own, and shifts them in. HuBERT can't see the last `PADDED_FRAMES`
+of the window, so their features repeat the frame before them until the
+next block extracts them again, and they are left out of the synthesis.
+The synthesizer sees the rest of the window but only decodes its tail,
+through the `rate` argument of `infer`.
+
+Consecutive blocks are joined like SOLA: the start of each block is shifted
+by up to `search_frames` to line up best with the end of the previous block
+and cross-faded with it over `crossfade_frames`. The output lags the input
+by `crossfade_frames + search_frames + PADDED_FRAMES` on top of the block
+length and the time it takes to convert a block.
+
+`stream` is the stdin/stdout frontend behind `python main.py --stream`:
+
+    ffmpeg -i in.wav -f s16le -ac 1 -ar 16000 - | python main.py --stream | ffplay -f s16le -ar 40000 -ac 1 -
+"""
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import signal
+from rvc.lib.vc_infer_pipeline import ah, bh, coarse_f0
+
+# all lengths in 10 ms frames
+STREAM_PARAMS = {
+    "block_frames": 20,
+    "context_frames": 100,  # past audio the synthesizer sees in front of the block
+    "feature_context_frames": 50,  # past audio HuBERT sees in front of the new frames
+    "f0_context_frames": 16,  # same for the f0 extractor
+    "crossfade_frames": 5,
+    "search_frames": 1,
+}
+
+# the convolutions of HuBERT cut off the last one or two 10 ms frames
+PADDED_FRAMES = 2
+
+SAMPLE_FORMATS = {"s16le": np.dtype("<i2"), "f32le": np.dtype("<f4")}
+
+
+def roll_in(buffer, new, shift=None):
+    """Shift `buffer` by `shift` frames along dim 1 and write `new` to its end.
+
+    `new` is longer than `shift` when it replaces frames that are already there.
+    """
+    n = new.shape[1] if shift is None else shift
+    buffer[:, :-n] = buffer[:, n:].clone()
+    buffer[:, -new.shape[1] :] = new
+
+
+class StreamConverter:
+    def __init__(self, engine, model_path: str, params, stream_params: dict = None):
+        """Convert with the voice model at `model_path` and the `InferenceParams` `params`."""
+        voice_model = engine.get_model(model_path, params.index_path())
+        self.config = engine.config
+        self.config.load_hubert(9 if voice_model.version == "v1" else 12)
+        self.vc = voice_model.vc
+        self.net_g = voice_model.net_g
+        self.if_f0 = voice_model.if_f0
+        self.version = voice_model.version
+        self.tgt_sr = voice_model.tgt_sr
+        self.index, self.big_npy = voice_model.get_index()
+        self.params = params
+        self.device = self.config.device
+        self.dtype = torch.float16 if self.config.is_half else torch.float32
+        self.sid = torch.tensor([params.sid], device=self.device).long()
+
+        stream_params = dict(STREAM_PARAMS, **(stream_params or {}))
+        self.block = stream_params["block_frames"]
+        self.crossfade = stream_params["crossfade_frames"]
+        self.search = stream_params["search_frames"]
+        self.feature_context = stream_params["feature_context_frames"]
+        self.f0_context = stream_params["f0_context_frames"]
+        self.n_frames = stream_params["context_frames"] + self.block + self.crossfade + self.search + PADDED_FRAMES
+        self.block_samples = self.block * self.vc.window
+        upp = self.tgt_sr // 100
+        self.output_block = self.block * upp
+        self.crossfade_samples = self.crossfade * upp
+        self.search_samples = self.search * upp
+        fade = torch.sin(0.5 * np.pi * torch.linspace(0, 1, self.crossfade_samples, device=self.device)) ** 2
+        self.fade_in = fade
+        self.fade_out = 1 - fade
+        self.reset()
+
+    @property
+    def latency(self) -> float:
+        """Seconds the output lags the input, without the conversion time."""
+        return (self.block + self.crossfade + self.search + PADDED_FRAMES) * self.vc.window / self.vc.sr
+
+    def reset(self):
+        """Forget the past audio, as at the start of a new stream."""
+        self.audio = np.zeros(self.n_frames * self.vc.window, dtype=np.float32)
+        self.filter_state = signal.lfilter_zi(bh, ah) * 0
+        # allocated by the first block, which fills the whole window
+        self.feats = None
+        self.pitch = torch.ones(1, self.n_frames, dtype=torch.long, device=self.device)
+        self.pitchf = torch.zeros(1, self.n_frames, dtype=torch.float32, device=self.device)
+        self.sola_buffer = None
+        self.times = []
+
+    def warm_up(self):
+        """Convert a block of silence so the first real block isn't slowed by lazy initialization."""
+        self.convert_block(np.zeros(self.block_samples, dtype=np.float32))
+        self.reset()
+
+    def extract_f0(self, n_update):
+        """Coarse and fine f0 of the last `n_update` frames of the window."""
+        window = self.vc.window
+        n_samples = min(self.n_frames, n_update + self.f0_context) * window
+        p_len = n_samples // window
+        f0 = self.vc.compute_f0(self.audio[-n_samples:], p_len, self.params.f0_method, 50, 1100)
+        f0 = f0[:p_len][-n_update:] * pow(2, self.params.f0_up_key / 12)
+        pitch = torch.from_numpy(coarse_f0(f0)).to(self.device).unsqueeze(0).long()
+        pitchf = torch.from_numpy(f0).to(self.device).unsqueeze(0).float()
+        return pitch, pitchf
+
+    def extract_features(self, n_update, pitchf):
+        """Features of the last `n_update` frames of the window, blended with the index.
+
+        `pitchf` holds the f0 of the same frames for the protection of unvoiced ones.
+        """
+        window = self.vc.window
+        n_samples = min(self.n_frames, n_update + self.feature_context) * window
+        feats0 = self.vc.extract_features(self.config.hubert_model, [self.audio[-n_samples:]], self.version)[0]
+        # 20 ms HuBERT frames to 10 ms frames, the convolutions cut off the
+        # last frame or two which repeat the last HuBERT frame
+        feats0 = feats0.repeat_interleave(2, dim=1)
+        missing = n_samples // window - feats0.shape[1]
+        if missing > 0:
+            feats0 = torch.cat([feats0, feats0[:, -1:].expand(-1, missing, -1)], 1)
+        feats0 = feats0[:, -n_update:]
+        index_rate = self.params.index_rate
+        if self.index is None or self.big_npy is None or index_rate == 0:
+            return feats0
+        npy = feats0[0].cpu().numpy().astype("float32")
+        score, ix = self.index.search(npy, k=8)
+        weight = np.square(1 / score)
+        weight /= weight.sum(axis=1, keepdims=True)
+        npy = np.sum(self.big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+        feats = torch.from_numpy(npy).unsqueeze(0).to(self.device, feats0.dtype) * index_rate + (1 - index_rate) * feats0
+        if pitchf is not None and self.params.protect < 0.5:
+            # unvoiced frames keep part of the features from before the index search
+            pitchff = torch.full(pitchf.shape, self.params.protect, dtype=feats.dtype, device=self.device)
+            pitchff.masked_fill_(pitchf > 0, 1)
+            pitchff = pitchff.unsqueeze(-1)
+            feats = feats * pitchff + feats0 * (1 - pitchff)
+        return feats
+
+    def convert_block(self, block):
+        """Convert `block_samples` of 16 kHz audio, returns `output_block` samples at `tgt_sr`."""
+        t0 = time.perf_counter()
+        block, self.filter_state = signal.lfilter(bh, ah, block, zi=self.filter_state)
+        self.audio[: -self.block_samples] = self.audio[self.block_samples :]
+        self.audio[-self.block_samples :] = block
+        # the first block fills the whole window, later ones only their new frames
+        n_update = self.n_frames if self.feats is None else self.block
+        if self.if_f0 == 1:
+            pitch, pitchf = self.extract_f0(n_update)
+            roll_in(self.pitch, pitch)
+            roll_in(self.pitchf, pitchf)
+        # the padded frames of the last block are extracted again now that HuBERT sees them
+        n_fresh = min(self.n_frames, n_update + PADDED_FRAMES)
+        feats = self.extract_features(n_fresh, self.pitchf[:, -n_fresh:] if self.if_f0 == 1 else None)
+        if self.feats is None:
+            self.feats = feats.clone()
+        else:
+            roll_in(self.feats, feats, n_update)
+
+        # the padded frames at the end are decoded with the next block
+        n_frames = self.n_frames - PADDED_FRAMES
+        head = self.block + self.crossfade + self.search
+        # infer decodes int(n_frames * rate) frames, the half frame keeps that from rounding down
+        rate = (head + 0.5) / n_frames
+        p_len = torch.tensor([n_frames], device=self.device).long()
+        feats = self.feats[:, :n_frames]
+        with torch.no_grad():
+            if self.if_f0 == 1:
+                audio = self.net_g.infer(feats, p_len, self.pitch[:, :n_frames], self.pitchf[:, :n_frames], self.sid, rate)[0][0, 0]
+            else:
+                audio = self.net_g.infer(feats, p_len, self.sid, rate)[0][0, 0]
+        audio = audio.float()
+
+        offset = 0
+        if self.sola_buffer is not None:
+            # the shift where the start of the block is most similar to the end of the last one
+            start = audio[None, None, : self.crossfade_samples + self.search_samples]
+            correlation = F.conv1d(start, self.sola_buffer[None, None])[0, 0]
+            energy = F.conv1d(start**2, torch.ones(1, 1, self.crossfade_samples, device=self.device))[0, 0]
+            offset = int(torch.argmax(correlation / torch.sqrt(energy + 1e-8)))
+        audio = audio[offset:]
+        output = audio[: self.output_block].clone()
+        if self.sola_buffer is not None:
+            output[: self.crossfade_samples] *= self.fade_in
+            output[: self.crossfade_samples] += self.sola_buffer * self.fade_out
+        self.sola_buffer = audio[self.output_block : self.output_block + self.crossfade_samples].clone()
+        output = output.cpu().numpy()
+        self.times.append(time.perf_counter() - t0)
+        return output
+
+
+def stream(converter: StreamConverter, input=None, output=None, sample_format: str = "s16le", report=sys.stderr):
+    """Convert raw mono 16 kHz PCM from `input` to PCM at the target rate on `output` until it ends.
+
+    Reports the conversion time and real-time factor of every block and a
+    summary at the end on `report`.
+    """
+    input = sys.stdin.buffer if input is None else input
+    output = sys.stdout.buffer if output is None else output
+    dtype = SAMPLE_FORMATS[sample_format]
+    block_seconds = converter.block_samples / converter.vc.sr
+
+    def write(audio):
+        if dtype.kind == "i":
+            audio = np.clip(audio * 32768, -32768, 32767)
+        output.write(audio.astype(dtype).tobytes())
+        output.flush()
+
+    print(
+        f"streaming {sample_format} at 16000 Hz in, {converter.tgt_sr} Hz out, "
+        f"{block_seconds * 1000:.0f} ms blocks, {converter.latency * 1000:.0f} ms latency plus conversion",
+        file=report,
+    )
+    n_blocks = 0
+    while True:
+        data = input.read(converter.block_samples * dtype.itemsize)
+        if not data:
+            break
+        block = np.frombuffer(data[: len(data) // dtype.itemsize * dtype.itemsize], dtype).astype(np.float32)
+        if dtype.kind == "i":
+            block /= 32768
+        if block.shape[0] < converter.block_samples:
+            block = np.pad(block, (0, converter.block_samples - block.shape[0]))
+        write(converter.convert_block(block))
+        elapsed = converter.times[-1]
+        print(f"block {n_blocks}: {elapsed * 1000:.1f} ms, rtf {elapsed / block_seconds:.2f}", file=report)
+        n_blocks += 1
+    if n_blocks == 0:
+        return
+    # the end of the input is still in the cross-fade, search and padded region
+    remaining = (converter.crossfade + converter.search + PADDED_FRAMES) * converter.tgt_sr // 100
+    while remaining > 0:
+        audio = converter.convert_block(np.zeros(converter.block_samples, dtype=np.float32))
+        write(audio[:remaining])
+        remaining -= audio.shape[0]
+    times = np.array(converter.times[:n_blocks]) * 1000
+    print(
+        f"{n_blocks} blocks: mean {times.mean():.1f} ms, p95 {np.percentile(times, 95):.1f} ms, "
+        f"max {times.max():.1f} ms, rtf {times.mean() / 1000 / block_seconds:.2f}",
+        file=report,
+    )